@@ -6,13 +6,36 @@ Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
 Created:        -
 Last Modified:  -
 License:        Apache 2.0
-Notes:          -
+Notes:          The date range is split in chunks (e.g. per month) that are
+                retrieved concurrently, the downloaded chunks are
+                concatenated in date order (grib messages are self
+                contained, so grib files can be concatenated).
+                Retrieved data is cached per day in <cachedir>, keyed by
+                the sha1 hash of the request for that day (without the
+                target), only days that are not in the cache are retrieved.
+                The least recently used days are removed when the cache
+                exceeds its maximum size.
 '''
 
 # import ecmwf api
 from ecmwfapi import ECMWFDataServer
 import argparse
+import datetime
+import hashlib
+import json
 import os
+import struct
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+# maximum number of concurrent requests per user on the ECMWF server
+MAX_PARALLEL = 3
+# directory for the downloaded chunks
+CHUNKDIR = 'interim_chunks'
+# size of the blocks copied when concatenating files
+CHUNK_SIZE = 1024 * 1024
+# default maximum size of the cache in GB
+CACHE_SIZE = 50.
 
 def define_pl_dict(date_string):
   ''' 
@@ -68,29 +91,296 @@ def check_date(date_text):
     raise ValueError("Date must be between 1979-01-01 and now: " + date_text)
   return datetime_object
 
-def move_downloaded_data(datadir, bdate):
+def date_chunks(dt1, dt2, chunk='month'):
+  '''
+  split the period dt1 to dt2 (inclusive) into consecutive (first, last)
+  periods of a 'day', 'month', 'year' or a number of days
+  '''
+  chunks = []
+  first = dt1
+  while first <= dt2:
+    if chunk == 'month':
+      next_first = (first.replace(day=1) +
+                    datetime.timedelta(days=32)).replace(day=1)
+    elif chunk == 'year':
+      next_first = first.replace(year=first.year + 1, month=1, day=1)
+    elif chunk == 'day':
+      next_first = first + datetime.timedelta(days=1)
+    else:
+      next_first = first + datetime.timedelta(days=int(chunk))
+    last = min(next_first - datetime.timedelta(days=1), dt2)
+    chunks.append((first, last))
+    first = next_first
+  return chunks
+
+def date_range_string(first, last):
+  '''
+  return the MARS date string of the period first to last
   '''
-  move downloaded files to data directory
+  if first == last:
+    return first.strftime('%Y-%m-%d')
+  return first.strftime('%Y-%m-%d') + '/to/' + last.strftime('%Y-%m-%d')
+
+def check_chunk(chunk):
+  '''
+  check if chunk is 'day', 'month', 'year' or a positive number of days
+  '''
+  if chunk in ['day', 'month', 'year']:
+    return chunk
+  if not chunk.isdigit() or int(chunk) < 1:
+    raise argparse.ArgumentTypeError("chunk must be day, month, year or a "
+                                     "number of days: " + chunk)
+  return chunk
+
+def retrieve(request):
+  '''
+  retrieve a single request, the data is downloaded to <target>.part which
+  is renamed to the target when complete
+  existing targets (from an earlier run) are not retrieved again
+  '''
+  target = request['target']
+  if os.path.exists(target):
+    return target
+  # each thread uses its own server connection
+  server = ECMWFDataServer()
+  server.retrieve(dict(request, target=target + '.part'))
+  os.rename(target + '.part', target)
+  return target
+
+def concatenate_files(filenames, outputfile):
+  '''
+  concatenate filenames in the given order to outputfile
   '''
   import shutil
-  # create destination directory, remove existing one if needed
+  with open(outputfile + '.part', 'wb') as output:
+    for filename in filenames:
+      with open(filename, 'rb') as fp:
+        shutil.copyfileobj(fp, output, CHUNK_SIZE)
+  os.rename(outputfile + '.part', outputfile)
+
+def iter_grib_messages(fp):
+  '''
+  yield the GRIB (edition 1 or 2) messages in file object fp
+  '''
+  while True:
+    header = fp.read(16)
+    if not header:
+      return
+    if len(header) < 16 or header[:4] != 'GRIB':
+      raise ValueError('No GRIB message at offset ' + str(fp.tell() -
+                                                          len(header)))
+    edition = ord(header[7])
+    if edition == 1:
+      length = struct.unpack('>I', '\x00' + header[4:7])[0]
+      if length & 0x800000:
+        raise ValueError('GRIB1 messages larger than 8 MB are not supported')
+    elif edition == 2:
+      length = struct.unpack('>Q', header[8:16])[0]
+    else:
+      raise ValueError('Unknown GRIB edition ' + str(edition))
+    message = header + fp.read(length - 16)
+    if len(message) != length:
+      raise ValueError('Truncated GRIB message')
+    yield message
+
+def grib_message_date(message):
+  '''
+  return the reference date of a GRIB message
+  '''
+  if ord(message[7]) == 1:
+    # section 1 starts at octet 9: year of century, month, day, century
+    year = (ord(message[32]) - 1) * 100 + ord(message[20])
+    return datetime.date(year, ord(message[21]), ord(message[22]))
+  # section 1 starts at octet 17: year (2 octets), month, day
+  year = struct.unpack('>H', message[28:30])[0]
+  return datetime.date(year, ord(message[30]), ord(message[31]))
+
+def missing_periods(days):
+  '''
+  group a sorted list of days into (first, last) periods of consecutive days
+  '''
+  periods = []
+  for day in days:
+    if periods and day == periods[-1][1] + datetime.timedelta(days=1):
+      periods[-1] = (periods[-1][0], day)
+    else:
+      periods.append((day, day))
+  return periods
+
+class grib_cache:
+  '''
+  content addressed cache of GRIB data per request and day, the least
+  recently used days are removed when the cache exceeds maxsize GB
+  '''
+  def __init__(self, cachedir, maxsize=CACHE_SIZE):
+    self.cachedir = cachedir
+    self.maxsize = int(maxsize * 1024 ** 3)
+    self.hits = 0
+    self.misses = 0
+    self.evicted = 0
+    if not os.path.exists(self.cachedir):
+      os.makedirs(self.cachedir)
+
+  @staticmethod
+  def key(request):
+    '''
+    return the sha1 hash of the canonical (sorted) json of a request
+    without its target
+    '''
+    request = dict((key, value) for key, value in request.items() if
+                   key != 'target')
+    return hashlib.sha1(json.dumps(request, sort_keys=True,
+                                   separators=(',', ':'))).hexdigest()
+
+  def filename(self, key):
+    '''
+    return the cache file of key
+    '''
+    return os.path.join(self.cachedir, key[:2], key + '.grib')
+
+  def __contains__(self, key):
+    return os.path.isfile(self.filename(key))
+
+  def touch(self, key):
+    '''
+    mark key as recently used
+    '''
+    os.utime(self.filename(key), None)
+
+  def store(self, gribfile, define_dict):
+    '''
+    split gribfile in days and store every day under the key of the
+    request define_dict(<day>), returns the stored days
+    '''
+    tmpfiles = {}
+    try:
+      with open(gribfile, 'rb') as fp:
+        for message in iter_grib_messages(fp):
+          day = grib_message_date(message)
+          if day not in tmpfiles:
+            fd, tmpfile = tempfile.mkstemp(dir=self.cachedir, suffix='.part')
+            tmpfiles[day] = (os.fdopen(fd, 'wb'), tmpfile)
+          tmpfiles[day][0].write(message)
+      for day, (output, tmpfile) in tmpfiles.items():
+        output.close()
+        filename = self.filename(self.key(define_dict(
+          day.strftime('%Y-%m-%d'))))
+        if not os.path.exists(os.path.dirname(filename)):
+          os.makedirs(os.path.dirname(filename))
+        os.rename(tmpfile, filename)
+    finally:
+      for output, tmpfile in tmpfiles.values():
+        output.close()
+        if os.path.exists(tmpfile):
+          os.remove(tmpfile)
+    return sorted(tmpfiles.keys())
+
+  def evict(self):
+    '''
+    remove the least recently used days until the cache size is at most
+    maxsize, returns the number of removed days
+    '''
+    entries = []
+    for root, dirnames, filenames in os.walk(self.cachedir):
+      for filename in filenames:
+        if filename.endswith('.grib'):
+          path = os.path.join(root, filename)
+          stat = os.stat(path)
+          entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for mtime, size, path in entries)
+    removed = 0
+    for mtime, size, path in sorted(entries):
+      if total <= self.maxsize:
+        break
+      os.remove(path)
+      total -= size
+      removed += 1
+    self.evicted += removed
+    return removed
+
+  def report(self):
+    '''
+    return a summary of the cache use
+    '''
+    return ('cache: %i days from cache, %i days retrieved, %i days evicted' %
+            (self.hits, self.misses, self.evicted))
+
+def retrieve_cached(define_dicts, dt1, dt2, cache, chunk='month',
+                    parallel=MAX_PARALLEL, chunkdir=CHUNKDIR):
+  '''
+  retrieve the requests of define_dicts (functions date_string -> request)
+  for all days from dt1 to dt2 (inclusive) and write them in date order to
+  the target of the request
+  days that are not in the cache are retrieved in chunks (see date_chunks)
+  using at most parallel concurrent requests and stored in the cache
+  '''
+  days = [dt1 + datetime.timedelta(days=n) for n in
+          range((dt2 - dt1).days + 1)]
+  requests = []
+  pieces = []
+  for define_dict in define_dicts:
+    missing = [day for day in days if cache.key(define_dict(
+      day.strftime('%Y-%m-%d'))) not in cache]
+    cache.hits += len(days) - len(missing)
+    cache.misses += len(missing)
+    for period in missing_periods(missing):
+      for first, last in date_chunks(period[0], period[1], chunk):
+        request = define_dict(date_range_string(first, last))
+        target = request['target']
+        request['target'] = os.path.join(chunkdir, '%s_%s-%s%s' % (
+          os.path.splitext(target)[0], first.strftime('%Y%m%d'),
+          last.strftime('%Y%m%d'), os.path.splitext(target)[1]))
+        pieces.append((define_dict, request['target']))
+        requests.append(request)
+  if requests and not os.path.exists(chunkdir):
+    os.makedirs(chunkdir)
+  # retrieve all chunks, the first error is raised when all requests are
+  # finished, completed chunks are kept for the next run
+  tpool = ThreadPool(parallel)
   try:
-    os.makedirs(os.path.join(datadir,bdate))
-  except OSError:  # directory exists
-    shutil.rmtree(os.path.join(datadir,bdate))
+    tpool.map(retrieve, requests, chunksize=1)
+  finally:
+    tpool.close()
+    tpool.join()
+  for define_dict, piece in pieces:
+    cache.store(piece, define_dict)
+    os.remove(piece)
+  if requests:
+    try:
+      os.rmdir(chunkdir)
+    except OSError:
+      pass  # directory is not empty
+  # write the targets from the cache
+  for define_dict in define_dicts:
+    keys = [cache.key(define_dict(day.strftime('%Y-%m-%d'))) for day in days]
+    for day, key in zip(days, keys):
+      if key not in cache:
+        raise IOError('No data retrieved for ' + day.strftime('%Y-%m-%d'))
+      cache.touch(key)
+    concatenate_files([cache.filename(key) for key in keys],
+                      define_dict(date_range_string(dt1, dt2))['target'])
+  cache.evict()
+  print (cache.report())
+
+def move_downloaded_data(datadir, bdate):
+  '''
+  move downloaded files to data directory, existing files with the same
+  name are replaced, other files in the directory are kept
+  '''
+  import shutil
+  # create destination directory if needed
+  if not os.path.exists(os.path.join(datadir,bdate)):
     os.makedirs(os.path.join(datadir,bdate))
   # move files
   for file in ['interim_pl.grib', 'interim_sfc.grib']:
     try:
-      shutil.move(file,os.path.join(datadir,bdate))
+      shutil.move(file,os.path.join(datadir,bdate,file))
     except IOError:
       pass
 
 
 def main(args):
   import re
-  # define server
-  server = ECMWFDataServer()
 
   if not True in [args.pl, args.sfc]:
     # add logging statement
@@ -98,26 +388,24 @@ def main(args):
 
   dt1 = check_date(args.date)
   if args.date2:
-    if not (check_date(args.date2) > dt1):
+    dt2 = check_date(args.date2)
+    if not (dt2 > dt1):
       raise ValueError('--date2 (' + args.date2 + ') must be after --date ('
                        + args.date + ').')
-    else:
-      date_string = args.date + '/to/' + args.date2
   else:
-    date_string = args.date
+    dt2 = dt1
   # define pressure and surface level dictionaries
+  define_dicts = []
   if args.pl:
-    # define dictionary
-    pl = define_pl_dict(date_string)
-    # retrieve pressure level data
-    server.retrieve(pl)
-
+    define_dicts.append(define_pl_dict)
   if args.sfc:
-    # define dictionary
-    sfc = define_sfc_dict(date_string)
-    # retrieve surface level data
-    server.retrieve(sfc)
-  
+    define_dicts.append(define_sfc_dict)
+  # retrieve pressure and surface level data, days that are not in the
+  # cache are retrieved in chunks
+  cache = grib_cache(args.cachedir, args.cachesize)
+  retrieve_cached(define_dicts, dt1.date(), dt2.date(), cache,
+                  chunk=args.chunk, parallel=args.parallel)
+
   # move downloaded data to data directory
   move_downloaded_data(args.datadir, re.sub('-','',args.date) + '00')
 
@@ -137,6 +425,17 @@ if __name__=="__main__":
   parser.add_argument('--sfc', help='download surface level fields [boolean, default: true]',
                       default=True, type=str2bool, required=False)
   parser.add_argument('--date2', help='Optional second date YYYY-MM-DD. Data will be downloaded between --data and --data2 in used.', required=False, type=str)
+  parser.add_argument('--chunk', help='split the period in chunks of a day, month, year or a number of days [default: month]',
+                      default='month', type=check_chunk, required=False)
+  parser.add_argument('--parallel', help='maximum number of concurrent requests [default: ' +
+                      str(MAX_PARALLEL) + ']',
+                      default=MAX_PARALLEL, type=int, required=False)
+  parser.add_argument('--cachedir', help='cache directory [default: ' +
+                      os.path.join(os.getcwd(),'ERAI_cache') + ']',
+                      default=os.path.join(os.getcwd(),'ERAI_cache'), required=False)
+  parser.add_argument('--cachesize', help='maximum cache size in GB [default: ' +
+                      str(CACHE_SIZE) + ']',
+                      default=CACHE_SIZE, type=float, required=False)
   parser.add_argument('--datadir', help='destination directory [default: ' +
                       os.path.join(os.getcwd(),'ERAI') + ']',
                       default=os.path.join(os.getcwd(),'ERAI'), required=False)
@@ -9,19 +9,56 @@ License:        Apache 2.0
 Notes:          -
 '''
 
+import json
+import logging
 import os
-import glob
-import fnmatch
-import zipfile
-import csv
+import re
+import sys
 import pandas
+from numpy import concatenate
+from numpy import cumsum
+from numpy import full
 from numpy import hstack
-from numpy import sort
-from numpy import zeros
+from numpy import isnan
+from numpy import unique
+from numpy import where
 import numpy as np
 from datetime import datetime
+# shared netcdf writer and derived variables are located in the knmi2netcdf
+# directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'knmi2netcdf'))
+from derived import dewpoint
+from derived import wind_uv
+from httpclient import write_atomic
+from ncwriter import append_variables
+from ncwriter import write_time
+from ncwriter import FILL_VALUE
+from ncwriter import write_variables
+from zipreader import read_members
+import utils
 
 datadir = 'data'
+# index of the station files in datadir (stored outside datadir, writing
+# it would change the modification time of datadir)
+STATION_INDEX = 'station_index.json'
+# station zip files: <product>_<variable>_<5 digit station id>_<...>.zip
+# e.g. stundenwerte_TU_00044_19690101_20151231_hist.zip
+STATION_FILE = re.compile(r'^[^_]+_[^_]+_(\d{5})_.*\.zip$')
+# policies for values of the same variable and time step in multiple files
+CONFLICT_POLICIES = ['first', 'last', 'error']
+# output variables:
+#   (source column, output variable, scale factor, fill value)
+VARIABLES = [('LUFTDRUCK_REDUZIERT', 'pressure_reduced', 1, FILL_VALUE),
+             ('LUFTDRUCK_STATIONSHOEHE', 'pressure_station', 100, FILL_VALUE),
+             ('REL_FEUCHTE', 'rltvh', 1, FILL_VALUE),
+             ('WINDRICHTUNG', 'winddir', 1, FILL_VALUE),
+             ('WINDGESCHWINDIGKEIT', 'windspeed', 1, FILL_VALUE),
+             ('GESAMT_BEDECKUNGSGRAD', 'clouds', 1, FILL_VALUE),
+             ('NIEDERSCHLAGSHOEHE', 'precipitation', 1, FILL_VALUE),
+             ('LUFTTEMPERATUR', 'temperature', 1, FILL_VALUE)]
+
+logger = logging.getLogger(__name__)
 
 def get_variables():
   '''
@@ -30,175 +67,192 @@ def get_variables():
   dirs = os.listdir(datadir)
   return dirs
 
-def get_list_of_stations(dirs):
+def scan_station_files():
   '''
-  extract station ids from ftp filenames, create unique list for all 
-  variables combined
+  scan datadir once and return (index, mtimes):
+    index: station id -> {variable: [zip files]}, the variable is the
+           top level directory in datadir
+    mtimes: directory -> modification time of all scanned directories
   '''
-  ids = []
-  for dir0 in dirs:
-    # list of files in current directory
-    files = glob.glob(os.path.join(datadir, dir0, '*.zip'))
-    ids = ids + [ filename[-32:-27] for filename in files if filename[-32:-27]
-           not in ids ]
-  return ids
+  index = {}
+  mtimes = {}
+  for root, dirnames, filenames in os.walk(datadir):
+    mtimes[root] = os.path.getmtime(root)
+    relpath = os.path.relpath(root, datadir)
+    if relpath == os.curdir:
+      continue  # no variable directory
+    variable = relpath.split(os.sep)[0]
+    for filename in filenames:
+      match = STATION_FILE.match(filename)
+      if match is None:
+        continue
+      files = index.setdefault(match.group(1), {}).setdefault(variable, [])
+      files.append(os.path.join(root, filename))
+  for variables in index.values():
+    for files in variables.values():
+      files.sort()
+  return index, mtimes
+
+def load_station_index(rescan=False):
+  '''
+  return the station file index of datadir (see scan_station_files)
+  the index is stored in STATION_INDEX and only rebuilt if a directory
+  changed since the last scan or rescan=True
+  '''
+  if not rescan:
+    try:
+      with open(STATION_INDEX, 'r') as fp:
+        stored = json.load(fp)
+      if all(os.path.getmtime(dirname) == mtime for dirname, mtime in
+             stored['mtimes'].items()):
+        return stored['index']
+    except (IOError, OSError, ValueError, KeyError):
+      pass  # no valid stored index, or a directory was removed
+  index, mtimes = scan_station_files()
+  write_atomic(os.path.abspath(STATION_INDEX),
+               json.dumps({'index': index, 'mtimes': mtimes}))
+  return index
+
+def get_list_of_stations(index):
+  '''
+  return the sorted station ids of the station file index
+  '''
+  return sorted(index.keys())
 
-def find_station_files(stationid):
+def find_station_files(index, stationid):
   '''
   find all zip files belonging to a given stationid
   '''
-  matches = []
-  for root, dirnames, filenames in os.walk(datadir):
-      for filename in fnmatch.filter(filenames, '*' + '_' + stationid + '_' +
-                                     '*.zip'):
-          matches.append(os.path.join(root, filename))
-  return matches
+  return sorted(sfile for files in index.get(stationid, {}).values() for
+                sfile in files)
 
 def load_file(station_zip):
   '''
-  load data files inside zip file and return data in a dictionary
-  '''
-  # load zipfile
-  zipf = zipfile.ZipFile(station_zip)
-  # list of files in zip
-  data_files = [ filename for filename in zipf.namelist() if 'produkt_' 
-                in filename ]
-  metadata_files = [ filename for filename in zipf.namelist() if
-                    'Stationsmetadaten' in filename ]
-  station_dict = read_data(zipf.open(data_files[0]))
-  meta_dict = pandas.read_csv(zipf.open(metadata_files[0]), engine='c', sep=';',
-                              skipinitialspace=True,
-                              header=0).to_dict(orient='records')
+  load data files inside zip file (file name or file object) and return
+  the station data and metadata, both members are read in a single open
+  of the zip file
+  '''
+  station_dict, meta_dict = read_members(
+    station_zip, [('*produkt_*', lambda member, info: read_data(member)),
+                  ('*Stationsmetadaten*',
+                   lambda member, info: read_metadata(member))])
   return station_dict, meta_dict
 
 
-#def read_data(filename):
-#  csvdict = pandas.read_csv(filename, engine='c', sep=';', dtype='a',
-#                            parse_dates=[' MESS_DATUM'],
-#                            header=0)[:-1].to_dict(orient='list')
-#  # remove some keys from dict
-#  csvdict.pop('eor', None)
-#  csvdict.pop('STATIONS_ID', None)
-#  csvdict.pop(' QUALITAETS_NIVEAU', None)
-#  return csvdict
-
-def read_data(filename):
+def read_metadata(filename):
   '''
-  Read csv data and return dictionary: index->
+  Read station metadata and return a list of dictionaries, one per period
   '''
-  try:
-    csvdict = pandas.read_csv(filename, engine='c', sep=';',
-                              parse_dates=['MESS_DATUM'], index_col=['MESS_DATUM'],
-                              header=0, skipinitialspace=True).to_dict(
-                              orient='index')
-  except ValueError:
-    try:
-      csvdict = pandas.read_csv(filename, engine='c', sep=';',
-                                parse_dates=['Mess_Datum'], index_col=['Mess_Datum'],
-                                header=0, skipinitialspace=True).to_dict(
-                                orient='index')
-    except ValueError:
-      return None
-  return csvdict
-
-def merge_dicts(*dict_args):
-    '''
-    Given any number of dicts, shallow copy and merge into a new dict,
-    precedence goes to key value pairs in latter dicts.
-    '''
-    result = {}
-    for dictionary in dict_args:
-        result.update(dictionary)
-    return result
-
-def merge(a, b, path=None):
-    "merges b into a"
-    if path is None: path = []
-    for key in b:
-        if key in a:
-            if isinstance(a[key], dict) and isinstance(b[key], dict):
-                merge(a[key], b[key], path + [str(key)])
-            elif a[key] == b[key]:
-                pass # same leaf value
-            else:
-                #raise Exception('Conflict at %s' % '.'.join(path + [str(key)]))
-                pass  # keep original keys if keys are the same
-        else:
-            a[key] = b[key]
-    return a
-    
-def convert_dict(dict_of_dicts):
-  time_axis = sort(dict_of_dicts.keys())
-  pressure_reduced = zeros(len(time_axis))
-  pressure_station = zeros(len(time_axis))
-  rltvh = zeros(len(time_axis))
-  rltvh = zeros(len(time_axis))
-  winddir = zeros(len(time_axis))
-  windspeed = zeros(len(time_axis))
-  clouds = zeros(len(time_axis))
-  precipitation = zeros(len(time_axis))
-  temperature = zeros(len(time_axis))
-  
-  # remove nans from time_axis
-  time_axis = time_axis[~np.isnan(time_axis)]
+  return pandas.read_csv(filename, engine='c', sep=';',
+                         skipinitialspace=True,
+                         header=0).to_dict(orient='records')
 
-  for idx, c in enumerate(time_axis):
-    try:
-      pressure_reduced[idx] = dict_of_dicts[c]['LUFTDRUCK_REDUZIERT']
-    except KeyError:
-      pressure_reduced[idx] = -999
-    try:
-      pressure_station[idx] = 100 * dict_of_dicts[c]['LUFTDRUCK_STATIONSHOEHE']
-    except KeyError:
-      pressure_station[idx] = -999
-    try:
-      rltvh[idx] = dict_of_dicts[c]['REL_FEUCHTE']
-    except KeyError:
-      rltvh[idx] = -999
-    try:
-      winddir[idx] = dict_of_dicts[c]['WINDRICHTUNG']
-    except KeyError:
-      winddir[idx] = -999
-    try:
-      windspeed[idx] = dict_of_dicts[c]['WINDGESCHWINDIGKEIT']
-    except KeyError:
-      windspeed[idx] = -999
-    try:
-      clouds[idx] = dict_of_dicts[c]['GESAMT_BEDECKUNGSGRAD']
-    except KeyError:
-      clouds[idx] = -999
-    try:
-      precipitation[idx] = dict_of_dicts[c]['NIEDERSCHLAGSHOEHE']
-    except KeyError:
-      precipitation[idx] = -999
-    try:
-      temperature[idx] = dict_of_dicts[c]['LUFTTEMPERATUR']
-    except KeyError:
-      temperature[idx] = -999
+def read_data(filename, variables=VARIABLES):
+  '''
+  Read csv data into a dictionary of numpy columns, the time axis is
+  stored as datetime64 in the 'time' column
+  only the source columns of variables are kept, quality and metadata
+  columns (QUALITAETS_NIVEAU, STRUKTUR_VERSION, QN_*, ...) are shared by
+  all products and must not be joined
+  returns None if the file has no MESS_DATUM (or Mess_Datum) column
+  '''
+  table = pandas.read_csv(filename, engine='c', sep=';', header=0,
+                          skipinitialspace=True)
+  # spelling and whitespace of the header differ between files
+  table.columns = [str(name).strip() for name in table.columns]
+  datecolumns = [name for name in table.columns if
+                 name.upper() == 'MESS_DATUM']
+  if not datecolumns:
+    return None
+  # MESS_DATUM is YYYYMMDDHH, rows without a valid date are dropped
+  stamps = pandas.to_numeric(table[datecolumns[0]], errors='coerce').values
+  valid = ~np.isnan(stamps)
+  stamps = stamps[valid].astype('int64')
+  data = {'time': utils.datetime_axis(stamps // 100, stamps % 100)}
+  sources = set(source for source, target, scale, fill in variables)
+  for name in table.columns:
+    if name.upper() not in sources:
+      continue  # date, quality, metadata and text columns such as eor
+    data[name.upper()] = pandas.to_numeric(table[name],
+                                           errors='coerce').values[valid]
+  return data
 
+def join_columns(tables, policy='first', timekey='time'):
+  '''
+  outer join of column tables on their time axis (timekey), the result
+  has one row per unique time step over all tables
+  missing values (nan or -999) never overwrite other values, a conflict is
+  a time step with different valid values for a variable in two tables:
+      policy='first': keep the value of the first table
+      policy='last': keep the value of the last table
+      policy='error': raise a ValueError
+  the number of conflicts per variable is logged
+  complexity O(n log n) for n time steps over all tables
+  '''
+  if policy not in CONFLICT_POLICIES:
+    raise ValueError('Unknown conflict policy: ' + str(policy))
+  tables = [table for table in tables if table is not None]
+  if not tables:
+    return None
+  # row of every time step of every table in the joined time axis
+  time_axis, rows = unique(concatenate([table[timekey] for table in tables]),
+                           return_inverse=True)
+  offsets = cumsum([0] + [len(table[timekey]) for table in tables])
+  keys = sorted(set().union(*[table.keys() for table in tables]) -
+                set([timekey]))
+  result = {timekey: time_axis}
+  for key in keys:
+    values = full(len(time_axis), np.nan)
+    conflicts = 0
+    for idx, table in enumerate(tables):
+      if key not in table:
+        continue
+      table_rows = rows[offsets[idx]:offsets[idx+1]]
+      new = np.asarray(table[key], dtype='float64')
+      valid = (new != FILL_VALUE) & ~isnan(new)
+      current = values[table_rows]
+      empty = isnan(current)
+      conflict = valid & ~empty & (current != new)
+      conflicts += conflict.sum()
+      if policy == 'error' and conflict.any():
+        raise ValueError(str(conflict.sum()) + ' conflicting values for ' +
+                         key + ' at ' + str(time_axis[table_rows][conflict][0]))
+      if policy == 'first':
+        valid &= empty
+      values[table_rows[valid]] = new[valid]
+    if conflicts:
+      logger.warning(str(conflicts) + ' conflicting values for ' + key +
+                     ', kept the ' + policy + ' value')
+    result[key] = values
+  return result
+
+def convert_dict(data, variables=VARIABLES):
+  '''
+  extract the output variables from the joined station columns as defined
+  in variables, missing values (nan or fill value) are not scaled and
+  become the fill value, variables that are missing in the station data
+  are filled with the fill value
+  '''
+  ntimes = len(data['time'])
   d = {}
-  d['pressure_reduced'] = pressure_reduced
-  d['pressure_station'] = pressure_station
-  d['rltvh'] = rltvh
-  d['winddir'] = winddir
-  d['windspeed'] = windspeed
-  d['clouds'] = clouds
-  d['precipitation'] = precipitation
-  d['temperature'] = temperature
-  d['time'] = [datetime.strptime(str(int(item)), ('%Y%m%d%H')) for
-               item in time_axis]
-  return d  
+  for source, target, scale_factor, fill_value in variables:
+    if source not in data:
+      d[target] = full(ntimes, fill_value, dtype='float64')
+      continue
+    values = np.asarray(data[source], dtype='float64')
+    missing = (values == fill_value) | isnan(values)
+    d[target] = where(missing, fill_value, scale_factor * values)
+  # derived variables
+  d['wind_u'], d['wind_v'] = wind_uv(d['windspeed'], d['winddir'])
+  d['dewpoint'] = dewpoint(d['temperature'], d['rltvh'])
+  d['time'] = data['time']
+  return d
 
 def write_combined_data_netcdf(data, stationid):
   '''
   description
   '''
   from netCDF4 import Dataset as ncdf
-  import netcdftime
-  from datetime import datetime
-  from dateutil import tz
-  from numpy import zeros
-  from numpy import nan as npnan
   from numpy import dtype
   import time
   ncfile = ncdf('output'+str(stationid)+'.nc', 'w', format='NETCDF4')
@@ -212,17 +266,8 @@ def write_combined_data_netcdf(data, stationid):
   latvar = ncfile.createDimension('latitude', 1)
   elevation_var = ncfile.createDimension('elevation', 1)
 
-  # inititalize time axis
-  timeaxis = [int(round(netcdftime.date2num(data['time'][idx], units='minutes since 2010-01-01 00:00:00',
-                                 calendar='gregorian'))) for idx in range(0,len(data['time']))]
   # netcdf time variable UTC
-  timevar = ncfile.createVariable('time', 'i4', ('time',),
-                                  zlib=True)
-  timevar[:] = timeaxis
-  timevar.units = 'minutes since 2010-01-01 00:00:00'
-  timevar.calendar = 'gregorian'
-  timevar.standard_name = 'time'
-  timevar.long_name = 'time in UTC'
+  timevar = write_time(ncfile, data['time'])
 
   # lon/lat variables
   lonvar = ncfile.createVariable('longitude',dtype('float32').char,('longitude',))
@@ -244,33 +289,37 @@ def write_combined_data_netcdf(data, stationid):
   elevation_var[:] = data['elevation']
   
   # create other variables in netcdf file
-  for variable in data.keys():
-    if variable not in ['time', 'longitude', 'latitude', 'elevation', None]:
-      # add variables in netcdf file
-      # convert strings to npnan if array contains numbers
-      if True in [is_number(c)
-        for c in data[variable]]:
-          data[variable] = [npnan if isinstance(
-            fitem(c), str) else fitem(c) for c in data[
-              variable]]
-      # check if variable is a string
-      if not isinstance(data[variable][1], str):
-          # fill variable
-          variableName = variable
-          values = ncfile.createVariable(
-            variableName, type(data[variable][1]),
-            ('time',), zlib=True, fill_value=-999)
-      else:
-        # string variables cannot have fill_value
-        values = ncfile.createVariable(
-          variable, type(data[variable][1]),
-          ('time',), zlib=True)
-      try:  # fill variable
-        values[:] = data[variable][:]
-      except IndexError:
-        # for strings the syntax is slightly different
-        values = data[variable][:]
-        #self.fill_attribute_data()
+  write_variables(ncfile, data, exclude=['time', 'longitude', 'latitude',
+                                         'elevation'])
+  ncfile.close()
+
+
+def append_combined_data_netcdf(data, stationid):
+  '''
+  append the time steps after the last time step in output<stationid>.nc
+  returns the number of appended time steps
+  '''
+  from netCDF4 import Dataset as ncdf
+  import time
+  ncfile = ncdf('output'+str(stationid)+'.nc', 'a')
+  try:
+    nsteps = append_variables(ncfile, data, 'time')
+    if nsteps > 0:
+      ncfile.history += '\nAppended ' + time.ctime(time.time())
+  finally:
+    ncfile.close()
+  return nsteps
+
+
+def is_up_to_date(station_files, stationid):
+  '''
+  check if output<stationid>.nc is newer than all station zip files
+  '''
+  outputfile = 'output' + str(stationid) + '.nc'
+  if not os.path.isfile(outputfile):
+    return False
+  return all(os.path.getmtime(sfile) <= os.path.getmtime(outputfile) for
+             sfile in station_files)
 
 
 def fill_attribute_data():
@@ -289,29 +338,6 @@ def fill_attribute_data():
     pass
 
 
-def fitem(item):
-    try:
-        item = item.strip()
-    except AttributeError:
-        pass
-    try:
-        item = float(item)
-    except ValueError:
-        pass
-    return item
-
-
-def is_number(s):
-    '''
-    check if the value in the string is a number and return True or False
-    '''
-    try:
-        float(s)
-        return True
-    except ValueError:
-        pass
-    return False
-
 def list_of_dict_to_dict_of_lists(tmp) :
    #result = {}
    #for d in l :
@@ -320,20 +346,11 @@ def list_of_dict_to_dict_of_lists(tmp) :
    #return result
    return {key:[item[key] for item in tmp] for key in tmp[0].keys() }
 
-def dict_of_list_to_list_of_dicts(d) :
-   if not d :
-      return []
-   #reserve as much *distinct* dicts as the longest sequence
-   result = [{} for i in range(max (map (len, d.values())))]
-   #fill each dict, one key at a time
-   for k, seq in d.items() :
-      for oneDict, oneValue in zip(result, seq) :
-        oneDict[k] = oneValue
-   return result
-
 def convert_meta_dict(metadata_dicts):
-  # find unique metadata information
-  metadata = {v['von_datum']:v for v in metadata_dicts}.values()
+  # find unique metadata information, sorted by von_datum: the n-th period
+  # is written to output<stationid>_<n>.nc, also in append mode
+  unique_periods = {v['von_datum']:v for v in metadata_dicts}
+  metadata = [unique_periods[key] for key in sorted(unique_periods)]
   # convert list of dicts to dict of lists
   metadata = list_of_dict_to_dict_of_lists(metadata)
   # convert timme to datetime objects
@@ -345,55 +362,102 @@ def convert_meta_dict(metadata_dicts):
 
 def split_data(results, metadata):
   '''
-  split station data based on moving station location in time
+  split station data based on moving station location in time,
+  returns a list with a dictionary for every period with data in it,
+  the columns are slices (views) of the columns in results
   '''
+  # first and last+1 index of every von_datum/bis_datum period in the
+  # (sorted) time axis
+  time_axis = results['time']
+  start = np.searchsorted(time_axis, np.array(metadata['von_datum'],
+                                              dtype='datetime64[s]'),
+                          side='left')
+  stop = np.searchsorted(time_axis, np.array(metadata['bis_datum'],
+                                             dtype='datetime64[s]'),
+                         side='right')
   data = []
   for idd in range(0,len(metadata['von_datum'])):
-    tmp = [ { key : results[key][idx] for key in results.keys() }
-            for idx, x in enumerate(results["time"]) if
-            metadata['von_datum'][idd]<=x<=metadata['bis_datum'][idd]]
-    if not tmp:
+    if start[idd] >= stop[idd]:
       continue  # no measurements found for time period
-    tmp_out = list_of_dict_to_dict_of_lists(tmp)
+    tmp_out = {key: results[key][start[idd]:stop[idd]] for key in
+               results.keys()}
     tmp_out['longitude'] = metadata['Geogr.Breite'][idd]
     tmp_out['latitude'] = metadata['Geogr.Laenge'][idd]
     tmp_out['elevation'] = metadata['Stationshoehe'][idd]
-    data = hstack((data,tmp_out))
+    data.append(tmp_out)
   return data
 
-def main():
-  dirs = get_variables()
-  ids = np.sort(get_list_of_stations(dirs))
+def convert_station(stationid, station_files, append=False, policy='first'):
+  '''
+  convert the zip files of a station (file names or file objects) to
+  output<stationid>[_n].nc, one file per station location
+  policy defines which value is kept for conflicting values of a variable
+  in multiple files (see join_columns)
+  '''
+  station_dicts = []
+  metadata_dicts = []
+  for sfile in station_files:
+    # load data in list of dicts
+    print (getattr(sfile, 'name', sfile))
+    sdict, mdict = load_file(sfile)
+    if sdict == None:
+      continue
+    station_dicts.append(sdict)
+    metadata_dicts = hstack((metadata_dicts, mdict))
+  # join station data of all files on the time axis
+  logger.info('Joining ' + str(len(station_dicts)) + ' files of station ' +
+              str(stationid))
+  results = join_columns(station_dicts, policy=policy)
+  if results is None:
+    return  # no station data found
+  # generate output dictionary
+  results = convert_dict(results)
+  # convert metadata_dicts
+  metadata = convert_meta_dict(metadata_dicts)
+  # split station data based on station location movements as specified
+  # in the metadata
+  r2 = split_data(results, metadata)
+  for idx in range(0,len(r2)):
+    if idx > 0:
+      outputid = stationid + '_' + str(idx+1)
+    else:
+      outputid = stationid
+    if append and os.path.isfile('output' + str(outputid) + '.nc'):
+      append_combined_data_netcdf(r2[idx], outputid)
+    else:
+      write_combined_data_netcdf(r2[idx], outputid)
+
+def main(append=False, policy='first'):
+  '''
+  convert all DWD stations, in append mode existing output files are only
+  extended with new time steps
+  policy defines which value is kept for conflicting values of a variable
+  in multiple files (see join_columns)
+  '''
+  index = load_station_index()
+  ids = get_list_of_stations(index)
   for st in range(0,len(ids)):
     print (ids[st])
-    station_files = find_station_files(ids[st])
-    station_dicts = []
-    metadata_dicts = []
-    for sfile in station_files:
-      # load data in list of dicts
-      print (sfile)
-      sdict, mdict = load_file(sfile)
-      if sdict == None:
-        continue
-      station_dicts = hstack((station_dicts, sdict))
-      metadata_dicts = hstack((metadata_dicts, mdict))
-    # merge station data dicts
-    results = reduce(merge, station_dicts)
-    # generate output dictionary
-    results = convert_dict(results)
-    # convert metadata_dicts
-    metadata = convert_meta_dict(metadata_dicts)
-    # split station data based on station location movements as specified
-    # in the metadata
-    r2 = split_data(results, metadata)
-    for idx in range(0,len(r2)):
-      if idx > 0:
-        write_combined_data_netcdf(r2[idx], ids[st] + '_' + str(idx+1))
-      else:
-        write_combined_data_netcdf(r2[idx], ids[st])
+    station_files = find_station_files(index, ids[st])
+    if append and is_up_to_date(station_files, ids[st]):
+      continue  # no new data since last conversion
+    convert_station(ids[st], station_files, append=append, policy=policy)
 
 
 if __name__=="__main__":
-  main()
+  import argparse
+  parser = argparse.ArgumentParser(description='Convert DWD data to netCDF')
+  parser.add_argument('-a', '--append', help='Append new data to existing output files',
+                      required=False, action='store_true')
+  parser.add_argument('-p', '--policy', help='Value to keep for conflicting data in multiple files',
+                      choices=CONFLICT_POLICIES, default='first', required=False)
+  parser.add_argument('-l', '--log', help='Log level',
+                      choices=utils.LOG_LEVELS_LIST,
+                      default=utils.DEFAULT_LOG_LEVEL)
+  opts = parser.parse_args()
+  # define logger
+  logname = os.path.basename(__file__) + '.log'
+  utils.start_logging(filename=logname, level=opts.log)
+  main(append=opts.append, policy=opts.policy)
 
 
@@ -6,61 +6,463 @@ Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
 Created:        -
 Last Modified:  -
 License:        Apache 2.0
-Notes:          -
+Notes:          The ftp directory is mirrored incrementally: the size and
+                modification time (MDTM) of every downloaded file are kept
+                in <outputdir>/.manifest.json, files that did not change on
+                the server are not downloaded again.
+                Files are downloaded to a temporary file in the output
+                directory, which is renamed when the download is complete.
+                With --convert the files are not stored: downloads are kept
+                in memory and every station is converted to netCDF
+                (convert_data.py) as soon as all of its files arrived.
 '''
 
 from ftplib import FTP
+import ftplib
+import io
+import json
+import logging
 import os
+import posixpath
+import Queue
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+# write_atomic and utils are located in the knmi2netcdf directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'knmi2netcdf'))
+from httpclient import write_atomic
 
 # global variables
 global ftphost
 ftphost = 'ftp-cdc.dwd.de'
+FTPDIR = '/pub/CDC/observations_germany/climate/hourly/'
+# variable directories that are not downloaded
+EXCLUDE = ['solar']
+# name of the manifest file in the output directory
+MANIFEST = '.manifest.json'
+# size of the blocks read from the ftp server
+CHUNK_SIZE = 1024 * 1024
+# errors on a dropped or broken connection, the request is retried
+CONNECTION_ERRORS = (ftplib.error_temp, ftplib.error_reply, EOFError,
+                     socket.error)
 
-def ftp_connect(ftphost):
+logger = logging.getLogger(__name__)
+
+def ftp_connect(ftphost, port=21, timeout=60):
   '''
   connect to ftp host
   '''
-  ftp = FTP(ftphost)  # connect to host, default port
+  ftp = FTP()
+  ftp.connect(ftphost, port, timeout)
   ftp.login()  # user anonymous, passwd anonymous@
   return ftp
 
-def getbinary(ftp, filename, ofile):
+def getbinary(ftp, filename, ofile, size=None):
+  '''
+  download binary from ftp to a temporary file that is renamed to ofile
+  when complete, size (if given) is the expected size of the file
+  '''
+  fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(ofile)),
+                                 suffix='.part')
+  try:
+    with os.fdopen(fd, 'wb') as outfile:
+      ftp.retrbinary("RETR " + filename, outfile.write, blocksize=CHUNK_SIZE)
+    if size is not None and os.path.getsize(tmpfile) != size:
+      raise EOFError('Incomplete download of ' + filename + ': ' +
+                     str(os.path.getsize(tmpfile)) + ' of ' + str(size) +
+                     ' bytes')
+    # mkstemp creates the file readable for the owner only
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmpfile, 0o666 & ~umask)
+    os.rename(tmpfile, ofile)
+  except:
+    os.remove(tmpfile)
+    raise
+
+def getbuffer(ftp, filename, size=None):
   '''
-  download binary from ftp
+  download binary from ftp into memory, returns an io.BytesIO object
   '''
-  outfile = open(ofile, 'w')
-  ftp.retrbinary("RETR " + filename, outfile.write)
-  outfile.close()
-  
+  buffer = io.BytesIO()
+  ftp.retrbinary("RETR " + filename, buffer.write, blocksize=CHUNK_SIZE)
+  if size is not None and buffer.tell() != size:
+    raise EOFError('Incomplete download of ' + filename + ': ' +
+                   str(buffer.tell()) + ' of ' + str(size) + ' bytes')
+  buffer.seek(0)
+  return buffer
+
 def ftp_disconnect(ftp):
   '''
   disconnect ftp connection
   '''
-  ftp.quit()
+  try:
+    ftp.quit()
+  except ftplib.all_errors:
+    ftp.close()
+
+class ftp_pool:
+  '''
+  pool of at most size ftp connections shared by threads, connections are
+  opened when needed and reopened when they drop
+  '''
+  def __init__(self, ftphost, port=21, size=4, timeout=60):
+    self.ftphost = ftphost
+    self.port = port
+    self.timeout = timeout
+    self.idle = Queue.Queue()
+    self.slots = threading.Semaphore(size)
+
+  def acquire(self):
+    '''
+    return an idle connection or open a new one, blocks if all
+    connections are in use
+    '''
+    self.slots.acquire()
+    try:
+      return self.idle.get_nowait()
+    except Queue.Empty:
+      pass
+    try:
+      return ftp_connect(self.ftphost, self.port, self.timeout)
+    except:
+      self.slots.release()
+      raise
+
+  def release(self, ftp, broken=False):
+    '''
+    return a connection to the pool, broken connections are closed
+    '''
+    if broken:
+      ftp.close()
+    else:
+      self.idle.put(ftp)
+    self.slots.release()
+
+  def call(self, func, retries=2):
+    '''
+    return func(ftp) with a connection from the pool, on a connection
+    error the connection is reopened and func is retried up to retries
+    times
+    '''
+    for attempt in range(retries + 1):
+      ftp = self.acquire()
+      try:
+        result = func(ftp)
+      except CONNECTION_ERRORS as e:
+        self.release(ftp, broken=True)
+        if attempt == retries:
+          raise
+        logger.warning('Reconnecting to ' + self.ftphost + ': ' + str(e))
+        continue
+      except:
+        self.release(ftp)
+        raise
+      self.release(ftp)
+      return result
+
+  def close(self):
+    '''
+    close all idle connections
+    '''
+    while True:
+      try:
+        ftp_disconnect(self.idle.get_nowait())
+      except Queue.Empty:
+        return
+
+def list_files(ftp, ftpdir, extension='.zip'):
+  '''
+  return the names of the files in ftpdir with the given extension
+  '''
+  return sorted(posixpath.basename(name) for name in ftp.nlst(ftpdir) if
+                name.endswith(extension))
+
+def remote_file_info(ftp, filename):
+  '''
+  return the size and modification time (YYYYMMDDHHMMSS) of filename
+  '''
+  # SIZE needs binary mode, listings switch the connection to ascii mode
+  ftp.voidcmd('TYPE I')
+  size = ftp.size(filename)
+  mdtm = ftp.sendcmd('MDTM ' + filename).split()[-1]
+  return size, mdtm
+
+def load_manifest(outputdir):
+  '''
+  return the manifest of outputdir: local file -> {'size', 'mdtm'}
+  '''
+  try:
+    with open(os.path.join(outputdir, MANIFEST), 'r') as fp:
+      return json.load(fp)
+  except (IOError, ValueError):
+    return {}
+
+def save_manifest(outputdir, manifest):
+  '''
+  write the manifest of outputdir
+  '''
+  write_atomic(os.path.abspath(os.path.join(outputdir, MANIFEST)),
+               json.dumps(manifest, indent=0, sort_keys=True))
 
-def get_dwd_data(ftp):
+def mirror_file(pool, manifest, outputdir, remotefile, localfile):
   '''
-  download DWD data from ftp server
+  download remotefile to localfile (relative to outputdir) if it is not in
+  the manifest or its size or modification time changed
+  returns True if the file was downloaded, False if it was up to date
+  '''
+  size, mdtm = pool.call(lambda ftp: remote_file_info(ftp, remotefile))
+  entry = {'size': size, 'mdtm': mdtm}
+  ofile = os.path.join(outputdir, localfile)
+  if (manifest.get(localfile) == entry and os.path.isfile(ofile) and
+      os.path.getsize(ofile) == size):
+    return False
+  pool.call(lambda ftp: getbinary(ftp, remotefile, ofile, size))
+  manifest[localfile] = entry
+  return True
+
+def list_dwd_data(pool, ftpdir=FTPDIR, datatype='historical', threads=4):
+  '''
+  return (remote file, local file) tuples of the zip files in
+  <ftpdir>/<variable>/<datatype> of all variables, the local file is
+  <variable>/<filename>
   '''
-  ftpdir = '/pub/CDC/observations_germany/climate/hourly/'
-  datatype = 'historical'
-  # change working directory
-  ftp.cwd(ftpdir)
   # create list of subdirectories (variables are sort per subdir)
-  variables = []
-  ftp.dir('-d','*/',lambda L:variables.append(L.split()[-1]))
-  variables.remove('solar/')  # nothing to do for this directory
-  for variable in variables:
-    if not os.path.exists(variable):
-      os.makedirs(os.path.join('data', variable))
-    ftp.cwd(os.path.join(ftpdir, variable, 'historical'))
-    files = ftp.nlst('*.zip')
-    [ getbinary(ftp, filename, os.path.join('data', variable, filename)) for
-      filename in files ]
+  variables = [posixpath.basename(name.rstrip('/')) for name in
+               pool.call(lambda ftp: ftp.nlst(ftpdir))]
+  variables = [variable for variable in variables if variable not in EXCLUDE]
 
+  def list_variable(variable):
+    remotedir = posixpath.join(ftpdir, variable, datatype)
+    try:
+      files = pool.call(lambda ftp: list_files(ftp, remotedir))
+    except ftplib.error_perm:
+      return []  # not a variable directory
+    return [(posixpath.join(remotedir, filename),
+             posixpath.join(variable, filename)) for filename in files]
 
-if __name__=="__main__":
-  ftp = ftp_connect(ftphost)
-  get_dwd_data(ftp)
-  ftp_disconnect(ftp)
+  tpool = ThreadPool(threads)
+  try:
+    return [job for jobs in tpool.map(list_variable, variables, chunksize=1)
+            for job in jobs]
+  finally:
+    tpool.close()
+    tpool.join()
+
+def get_dwd_data(pool, outputdir='data', ftpdir=FTPDIR,
+                 datatype='historical', threads=4):
+  '''
+  mirror the zip files in <ftpdir>/<variable>/<datatype> of all variables
+  to <outputdir>/<variable>
+  returns the list of files that could not be downloaded
+  '''
+  jobs = list_dwd_data(pool, ftpdir, datatype, threads)
+  for variable in set(posixpath.dirname(localfile) for _, localfile in jobs):
+    if not os.path.exists(os.path.join(outputdir, variable)):
+      os.makedirs(os.path.join(outputdir, variable))
+  manifest = load_manifest(outputdir)
+
+  def download(job):
+    remotefile, localfile = job
+    try:
+      if mirror_file(pool, manifest, outputdir, remotefile, localfile):
+        logger.info('Downloaded ' + remotefile)
+      else:
+        logger.debug('Up to date ' + localfile)
+    except (ftplib.Error, IOError, OSError, EOFError, socket.error) as e:
+      logger.error('Error downloading file ' + remotefile + ': ' + str(e))
+      return remotefile
+
+  tpool = ThreadPool(threads)
+  try:
+    failed = tpool.map(download, jobs, chunksize=1)
+  finally:
+    tpool.close()
+    tpool.join()
+    # keep track of the completed downloads, also if interrupted
+    save_manifest(outputdir, manifest)
+  return [remotefile for remotefile in failed if remotefile is not None]
+
+def convert_buffers(args):
+  '''
+  convert the downloaded zip files (list of (local file, content) tuples)
+  of a station to netCDF with convert_data.convert_station
+  returns the station id, the elapsed time in seconds and an error
+  message (None if the conversion succeeded)
+  '''
+  import convert_data
+  stationid, buffers, append, policy = args
+  start = time.time()
+  station_files = []
+  for name, content in buffers:
+    station_file = io.BytesIO(content)
+    station_file.name = name
+    station_files.append(station_file)
+  try:
+    convert_data.convert_station(stationid, station_files, append=append,
+                                 policy=policy)
+  except Exception:
+    return stationid, time.time() - start, traceback.format_exc()
+  return stationid, time.time() - start, None
 
+def stream_dwd_data(pool, ftpdir=FTPDIR, datatype='historical', threads=4,
+                    workers=1, queuesize=16, append=False, policy='first'):
+  '''
+  download the zip files of all stations into memory and convert each
+  station to netCDF as soon as all of its files have arrived
+  downloads wait when queuesize downloaded files are not yet converted,
+  stations are converted by a pool of worker processes
+  returns the lists of files that could not be downloaded and stations
+  that could not be converted
+  '''
+  import multiprocessing
+  from convert_data import STATION_FILE
+  # expected files per station, downloads are ordered by station so only
+  # a few stations are incomplete at any time
+  stations = {}
+  for remotefile, localfile in list_dwd_data(pool, ftpdir, datatype,
+                                             threads):
+    match = STATION_FILE.match(posixpath.basename(localfile))
+    if match is not None:
+      stations.setdefault(match.group(1), []).append((remotefile, localfile))
+  jobs = [(stationid, remotefile, localfile) for stationid in
+          sorted(stations) for remotefile, localfile in stations[stationid]]
+  downloaded = Queue.Queue(maxsize=queuesize)
+  failed_downloads = []
+
+  def fetch(ftp, remotefile):
+    size, mdtm = remote_file_info(ftp, remotefile)
+    return getbuffer(ftp, remotefile, size).getvalue()
+
+  def download(job):
+    stationid, remotefile, localfile = job
+    try:
+      content = pool.call(lambda ftp: fetch(ftp, remotefile))
+      logger.info('Downloaded ' + remotefile)
+    except (ftplib.Error, IOError, OSError, EOFError, socket.error) as e:
+      logger.error('Error downloading file ' + remotefile + ': ' + str(e))
+      failed_downloads.append(remotefile)
+      content = None
+    downloaded.put((stationid, localfile, content))
+
+  def producer():
+    tpool = ThreadPool(threads)
+    try:
+      tpool.map(download, jobs, chunksize=1)
+    finally:
+      tpool.close()
+      tpool.join()
+      downloaded.put(None)
+
+  # fork the workers before any thread runs, a child process would inherit
+  # locks (e.g. of the logging handlers) held by the download threads
+  if workers > 1:
+    mpool = multiprocessing.Pool(processes=workers)
+  else:
+    mpool = None
+  thread = threading.Thread(target=producer)
+  thread.daemon = True
+  thread.start()
+  pending = []
+  failed_stations = []
+
+  def report(result):
+    stationid, seconds, error = result
+    if error is None:
+      print ('station %s converted in %.1f s' % (stationid, seconds))
+    else:
+      print ('station %s failed after %.1f s:\n%s' % (stationid, seconds,
+                                                      error))
+      failed_stations.append(stationid)
+
+  arrived = {}
+  try:
+    while True:
+      item = downloaded.get()
+      if item is None:
+        break  # all downloads are done
+      stationid, localfile, content = item
+      files = arrived.setdefault(stationid, [])
+      files.append((localfile, content))
+      if len(files) < len(stations[stationid]):
+        continue  # station is incomplete
+      del arrived[stationid]
+      # same order of the files as convert_data.find_station_files
+      buffers = [(name, content) for name, content in sorted(files) if
+                 content is not None]
+      if not buffers:
+        continue  # none of the files could be downloaded
+      args = (stationid, buffers, append, policy)
+      if mpool is None:
+        report(convert_buffers(args))
+        continue
+      pending.append(mpool.apply_async(convert_buffers, (args,)))
+      # limit the number of stations in memory waiting for a worker
+      while len(pending) > workers:
+        report(pending.pop(0).get())
+    for result in pending:
+      report(result.get())
+  finally:
+    if mpool is not None:
+      mpool.terminate()
+      mpool.join()
+  thread.join()
+  return failed_downloads, failed_stations
+
+
+if __name__=="__main__":
+  import argparse
+  import utils
+  parser = argparse.ArgumentParser(description='Mirror DWD hourly data')
+  parser.add_argument('--host', help='FTP host', default=ftphost,
+                      required=False)
+  parser.add_argument('--port', help='FTP port', default=21, type=int,
+                      required=False)
+  parser.add_argument('--ftpdir', help='Directory on the FTP host',
+                      default=FTPDIR, required=False)
+  parser.add_argument('-t', '--datatype', help='Data type subdirectory',
+                      default='historical', required=False)
+  parser.add_argument('-o', '--outputdir', help='Data output directory',
+                      default='data', required=False)
+  parser.add_argument('-n', '--connections', help='Number of FTP connections',
+                      default=4, type=int, required=False)
+  parser.add_argument('-c', '--convert', help='Convert stations to netCDF while downloading, without storing the zip files',
+                      required=False, action='store_true')
+  parser.add_argument('-w', '--workers', help='Number of conversion worker processes',
+                      default=1, type=int, required=False)
+  parser.add_argument('-q', '--queuesize', help='Maximum number of downloaded files waiting for conversion',
+                      default=16, type=int, required=False)
+  parser.add_argument('-a', '--append', help='Append new data to existing output files',
+                      required=False, action='store_true')
+  parser.add_argument('-p', '--policy', help='Value to keep for conflicting data in multiple files',
+                      choices=['first', 'last', 'error'], default='first',
+                      required=False)
+  parser.add_argument('-l', '--log', help='Log level',
+                      choices=utils.LOG_LEVELS_LIST,
+                      default=utils.DEFAULT_LOG_LEVEL)
+  opts = parser.parse_args()
+  # define logger
+  logname = os.path.basename(__file__) + '.log'
+  utils.start_logging(filename=logname, level=opts.log)
+  pool = ftp_pool(opts.host, opts.port, size=opts.connections)
+  failed_stations = []
+  try:
+    if opts.convert:
+      failed, failed_stations = stream_dwd_data(
+        pool, opts.ftpdir, opts.datatype, threads=opts.connections,
+        workers=opts.workers, queuesize=opts.queuesize, append=opts.append,
+        policy=opts.policy)
+    else:
+      failed = get_dwd_data(pool, opts.outputdir, opts.ftpdir,
+                            opts.datatype, threads=opts.connections)
+  finally:
+    pool.close()
+  for remotefile in failed:
+    print ('Failed to download ' + remotefile)
+  for stationid in failed_stations:
+    print ('Failed to convert station ' + stationid)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Benchmarks for the KNMI conversion on synthetic data
+                    * uurgeg: parse synthetic multi-decade uurgeg zip files
+                    * time: encode a 30-year hourly time axis
+                    * reproject: reproject points to Amersfoort (EPSG:28992)
+                    * ismember: align hourly timestamps of two stations
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:        -
+Last Modified:  -
+License:        Apache 2.0
+Notes:          -
+'''
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+from datetime import timedelta
+import numpy as np
+
+UURGEG_HEADER = ['# STN', 'YYYYMMDD', 'HH', 'DD', 'FH', 'FF', 'FX', 'T',
+                 'T10', 'TD', 'SQ', 'Q', 'DR', 'RH', 'P', 'VV', 'N', 'U',
+                 'WW', 'IX', 'M', 'R', 'S', 'O', 'Y']
+
+
+def timeit(func, *args, **kwargs):
+    '''
+    return the wall clock time of a single function call in seconds
+    '''
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+
+def synthetic_uurgeg(filename, stationid, start_year, years, seed=0):
+    '''
+    write a synthetic uurgeg zip file with hourly data for the given
+    number of years, about 1% of the fields are left empty
+    '''
+    rng = np.random.RandomState(seed)
+    start = datetime(start_year, 1, 1)
+    ndays = (datetime(start_year + years, 1, 1) - start).days
+    values = rng.randint(-100, 1000, size=(ndays * 24, len(UURGEG_HEADER)))
+    empty = rng.rand(ndays * 24, len(UURGEG_HEADER)) < 0.01
+    lines = ['# BRON: synthetic data for benchmarking', '#',
+             ','.join([UURGEG_HEADER[0]] +
+                      [name.rjust(5) for name in UURGEG_HEADER[1:]]), '']
+    for day in range(ndays):
+        datestr = (start + timedelta(days=day)).strftime('%Y%m%d')
+        for hour in range(24):
+            row = day * 24 + hour
+            fields = [str(value).rjust(5) if not empty[row, idx] else ' ' * 5
+                      for idx, value in enumerate(values[row, 3:], 3)]
+            lines.append(','.join([str(stationid).rjust(5), datestr,
+                                   str(hour + 1).rjust(5)] + fields))
+    zipf = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+    txtname = os.path.splitext(os.path.basename(filename))[0] + '.txt'
+    zipf.writestr(txtname, '\r\n'.join(lines) + '\r\n')
+    zipf.close()
+    return ndays * 24
+
+
+def benchmark_uurgeg(decades):
+    '''
+    time loading of synthetic uurgeg files of increasing length,
+    time per row should be constant for linear scaling
+    '''
+    from load_knmi_data import load_knmi_data
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print ('%8s %10s %10s %12s' % ('years', 'rows', 'seconds', 'us/row'))
+        for ndecades in decades:
+            filename = os.path.join(tmpdir, 'uurgeg_999_' + str(ndecades) +
+                                    '.zip')
+            nrows = synthetic_uurgeg(filename, 999, 1951, 10 * ndecades)
+            seconds = timeit(load_knmi_data, filename)
+            print ('%8i %10i %10.2f %12.2f' % (10 * ndecades, nrows, seconds,
+                                               1e6 * seconds / nrows))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchmark_time(years=30):
+    '''
+    compare per element netcdftime.date2num with the vectorized
+    ncwriter.encode_time on an hourly time axis
+    '''
+    try:
+        from netcdftime import date2num
+    except ImportError:
+        from cftime import date2num
+    from ncwriter import encode_time
+    from ncwriter import TIME_UNITS
+    times = np.arange('1981-01-01T01', str(1981 + years) + '-01-01T01',
+                      dtype='datetime64[h]').astype('datetime64[s]')
+    dates = times.tolist()
+    start = time.time()
+    reference = [int(round(date2num(item, units=TIME_UNITS,
+                                    calendar='gregorian'))) for item in dates]
+    seconds_reference = time.time() - start
+    start = time.time()
+    encoded = encode_time(times)
+    seconds_encoded = time.time() - start
+    assert (encoded == np.array(reference)).all()
+    print ('%i hourly time steps' % len(times))
+    print ('%-20s %10.3f s' % ('date2num per item', seconds_reference))
+    print ('%-20s %10.3f s' % ('encode_time', seconds_encoded))
+
+
+def benchmark_reproject(npoints=10000, seed=0):
+    '''
+    compare per point utils.ReprojectCoords with the batched
+    utils.reproject_coords for lat/lon -> Amersfoort
+    '''
+    from utils import ReprojectCoords
+    from utils import get_transformation
+    from utils import reproject_coords
+    from osgeo import osr
+    rng = np.random.RandomState(seed)
+    lon = rng.uniform(3.3, 7.2, npoints)
+    lat = rng.uniform(50.7, 53.6, npoints)
+    src_srs = osr.SpatialReference()
+    src_srs.ImportFromEPSG(4326)
+    tgt_srs = osr.SpatialReference()
+    tgt_srs.ImportFromEPSG(28992)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        tgt_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    start = time.time()
+    reference = [ReprojectCoords([x, y], src_srs, tgt_srs) for x, y in
+                 zip(lon, lat)]
+    seconds_reference = time.time() - start
+    # the first call creates the cached transformation
+    get_transformation(4326, 28992)
+    start = time.time()
+    x, y = reproject_coords(lon, lat, 4326, 28992)
+    seconds_batch = time.time() - start
+    assert np.allclose(np.array(reference), np.column_stack((x, y)))
+    print ('%i points' % npoints)
+    print ('%-20s %10.3f s' % ('ReprojectCoords', seconds_reference))
+    print ('%-20s %10.3f s' % ('reproject_coords', seconds_batch))
+
+
+def benchmark_ismember(years=30, seed=0):
+    '''
+    compare the dictionary based utils.ismember on python datetimes with
+    utils.ismember_indices on datetime64 for aligning the hourly time axes
+    of two stations with gaps
+    '''
+    from utils import ismember
+    from utils import ismember_indices
+    rng = np.random.RandomState(seed)
+    hours = np.arange('1981-01-01T01', str(1981 + years) + '-01-01T01',
+                      dtype='datetime64[h]').astype('datetime64[s]')
+    a = hours[rng.rand(len(hours)) < 0.9]
+    b = hours[rng.rand(len(hours)) < 0.9]
+    a_dates, b_dates = a.tolist(), b.tolist()
+    start = time.time()
+    reference = ismember(a_dates, b_dates)
+    seconds_reference = time.time() - start
+    start = time.time()
+    indices, found = ismember_indices(a, b)
+    seconds_indices = time.time() - start
+    assert (found == np.array([idx is not None for idx in reference])).all()
+    assert (indices[found] == np.array([idx for idx in reference
+                                        if idx is not None])).all()
+    print ('%i and %i hourly time steps' % (len(a), len(b)))
+    print ('%-20s %10.3f s' % ('ismember', seconds_reference))
+    print ('%-20s %10.3f s' % ('ismember_indices', seconds_indices))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark KNMI conversion')
+    benchmarks = ['uurgeg', 'time', 'reproject', 'ismember']
+    parser.add_argument('-b', '--benchmark', help='Benchmarks to run',
+                        nargs='+', choices=benchmarks, default=benchmarks,
+                        required=False)
+    parser.add_argument('-d', '--decades', help='Number of decades to test',
+                        nargs='+', type=int, default=[1, 2, 4, 6],
+                        required=False)
+    opts = parser.parse_args()
+    if 'uurgeg' in opts.benchmark:
+        benchmark_uurgeg(opts.decades)
+    if 'time' in opts.benchmark:
+        benchmark_time()
+    if 'reproject' in opts.benchmark:
+        benchmark_reproject()
+    if 'ismember' in opts.benchmark:
+        benchmark_ismember()
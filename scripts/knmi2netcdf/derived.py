@@ -0,0 +1,126 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Derived meteorological quantities on station data columns:
+                    * wind_uv(wind_speed, wind_direction)
+                    * dewpoint(temperature, relative_humidity)
+                    * relative_humidity(temperature, dewpoint)
+                    * sea_level_pressure(pressure, elevation, temperature)
+                    * thickness(pressure_bottom, pressure_top, temperature)
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:        -
+Last Modified:  -
+License:        Apache 2.0
+Notes:          All functions accept scalars, 1D station columns or stacked
+                (stations x time) 2D arrays, the inputs are broadcast
+                against each other. Elements where any input is missing
+                (fill_value or nan) are fill_value in the output.
+'''
+
+from numpy import asarray
+from numpy import broadcast_arrays
+from numpy import exp
+from numpy import full
+from numpy import isnan
+from numpy import log
+from numpy import ones
+import utils
+
+# missing values in the station data
+FILL_VALUE = -999
+# Magnus formula coefficients (Alduchov and Eskridge, 1996)
+MAGNUS_A = 17.625
+MAGNUS_B = 243.04  # degC
+# gas constant of dry air [J/(kg K)] and gravitational acceleration [m/s2]
+RD = 287.05
+G = 9.80665
+# standard atmosphere lapse rate [K/m]
+LAPSE_RATE = 0.0065
+
+
+def valid_inputs(args, fill_value=FILL_VALUE):
+    '''
+    broadcast the input arrays and return them together with a mask that
+    is True where none of the inputs is missing
+    '''
+    args = broadcast_arrays(*[asarray(arg, dtype='float64') for arg in args])
+    valid = ones(args[0].shape, dtype=bool)
+    for arg in args:
+        valid &= (arg != fill_value) & ~isnan(arg)
+    return args, valid
+
+
+def apply_masked(func, args, valid, fill_value=FILL_VALUE):
+    '''
+    evaluate func on the valid elements of args only, other elements are
+    fill_value
+    '''
+    result = full(valid.shape, fill_value, dtype='float64')
+    result[valid] = func(*[arg[valid] for arg in args])
+    return result
+
+
+def wind_uv(wind_speed, wind_direction, fill_value=FILL_VALUE):
+    '''
+    return U and V wind components from wind speed and wind direction
+    (in degrees), directions outside 0-360 (e.g. KNMI 990=variable) are
+    treated as missing
+    '''
+    args, valid = valid_inputs([wind_speed, wind_direction], fill_value)
+    valid &= (args[1] >= 0) & (args[1] <= 360)
+    u = full(valid.shape, fill_value, dtype='float64')
+    v = full(valid.shape, fill_value, dtype='float64')
+    u[valid], v[valid] = utils.wind_components(args[0][valid], args[1][valid])
+    return u, v
+
+
+def dewpoint(temperature, relative_humidity, fill_value=FILL_VALUE):
+    '''
+    return the dew point [degC] from temperature [degC] and relative
+    humidity [%]
+    '''
+    def kernel(t, rh):
+        gamma = log(rh / 100.) + MAGNUS_A * t / (MAGNUS_B + t)
+        return MAGNUS_B * gamma / (MAGNUS_A - gamma)
+    args, valid = valid_inputs([temperature, relative_humidity], fill_value)
+    valid &= args[1] > 0
+    return apply_masked(kernel, args, valid, fill_value)
+
+
+def relative_humidity(temperature, dewpoint, fill_value=FILL_VALUE):
+    '''
+    return the relative humidity [%] from temperature [degC] and
+    dew point [degC]
+    '''
+    def kernel(t, td):
+        return 100. * exp(MAGNUS_A * td / (MAGNUS_B + td) -
+                          MAGNUS_A * t / (MAGNUS_B + t))
+    args, valid = valid_inputs([temperature, dewpoint], fill_value)
+    return apply_masked(kernel, args, valid, fill_value)
+
+
+def sea_level_pressure(pressure, elevation, temperature,
+                       fill_value=FILL_VALUE):
+    '''
+    reduce station pressure to sea level, using the station elevation [m]
+    and temperature [degC], output has the units of pressure
+    '''
+    def kernel(p, z, t):
+        return p * (1. - LAPSE_RATE * z /
+                    (t + LAPSE_RATE * z + 273.15)) ** (-G / (RD * LAPSE_RATE))
+    args, valid = valid_inputs([pressure, elevation, temperature], fill_value)
+    return apply_masked(kernel, args, valid, fill_value)
+
+
+def thickness(pressure_bottom, pressure_top, temperature,
+              fill_value=FILL_VALUE):
+    '''
+    return the thickness [m] of the layer between two pressure levels
+    (same units) with mean layer temperature [degC]
+    '''
+    def kernel(p_bottom, p_top, t):
+        return RD * (t + 273.15) / G * log(p_bottom / p_top)
+    args, valid = valid_inputs([pressure_bottom, pressure_top, temperature],
+                               fill_value)
+    valid &= (args[0] > 0) & (args[1] > 0)
+    return apply_masked(kernel, args, valid, fill_value)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python2
+
+'''
+Description:    HTTP downloads over persistent connections:
+                    * connection_pool: persistent connections per thread/host
+                    * download_file(pool, url, outputfile, keep=True)
+                    * download_files(jobs, threads=4, keep=True)
+                    * thread_map(func, items, threads=4, cleanup=None)
+                    * page_cache: on-disk cache of web pages
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:        -
+Last Modified:  -
+License:        Apache 2.0
+Notes:          Files are downloaded to <outputfile>.part and renamed when
+                complete. The ETag of the download is kept in
+                <outputfile>.etag, so interrupted downloads can be resumed
+                with a Range request as long as the file on the server did
+                not change.
+                Cached pages are stored as <sha1(url)>.html with the ETag,
+                Last-Modified header and download time in <sha1(url)>.json.
+'''
+
+import hashlib
+import httplib
+import json
+import logging
+import os
+import Queue
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+# size of the blocks written to disk
+CHUNK_SIZE = 1024 * 1024
+# maximum number of redirects followed for a single request
+MAX_REDIRECTS = 5
+
+logger = logging.getLogger(__name__)
+
+
+class connection_pool:
+    '''
+    persistent HTTP(S) connections, one connection per host for each thread
+    '''
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connections(self):
+        '''
+        return the dictionary (scheme, host) -> connection of this thread
+        '''
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        return self.local.connections
+
+    def connection(self, scheme, netloc):
+        '''
+        return the connection to netloc, open a new one if needed
+        '''
+        connections = self.connections()
+        if (scheme, netloc) not in connections:
+            if scheme == 'https':
+                connection = httplib.HTTPSConnection(netloc,
+                                                     timeout=self.timeout)
+            else:
+                connection = httplib.HTTPConnection(netloc,
+                                                    timeout=self.timeout)
+            connections[(scheme, netloc)] = connection
+        return connections[(scheme, netloc)]
+
+    def discard(self, scheme, netloc):
+        '''
+        close and forget the connection to netloc
+        '''
+        connection = self.connections().pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def close(self):
+        '''
+        close all connections of this thread
+        '''
+        for scheme, netloc in self.connections().keys():
+            self.discard(scheme, netloc)
+
+    def request(self, method, url, headers=None, retries=1):
+        '''
+        send a request and return the response, redirects are followed
+        and a dropped connection is reopened up to retries times
+        the response must be read completely before the next request
+        '''
+        for redirect in range(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            for attempt in range(retries + 1):
+                connection = self.connection(parts.scheme, parts.netloc)
+                try:
+                    connection.request(method, path, headers=headers or {})
+                    response = connection.getresponse()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    self.discard(parts.scheme, parts.netloc)
+                    if attempt == retries:
+                        raise
+            if response.status not in [301, 302, 303, 307, 308]:
+                return response
+            response.read()
+            url = urlparse.urljoin(url, response.getheader('location'))
+        raise httplib.HTTPException('Too many redirects: ' + url)
+
+
+def read_etag(etagfile):
+    '''
+    return the ETag stored in etagfile, None if there is none
+    '''
+    try:
+        with open(etagfile, 'r') as fp:
+            return fp.read().strip() or None
+    except IOError:
+        return None
+
+
+def remove_files(filenames):
+    '''
+    remove all existing files in filenames
+    '''
+    for filename in filenames:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def download_file(pool, url, outputfile, keep=True):
+    '''
+    download url to outputfile in chunks of CHUNK_SIZE
+        keep=False: existing (partial) downloads are removed first
+        keep=True: an existing outputfile is kept if its size and ETag match
+                   the server, a partial download is resumed
+    returns False if outputfile was already complete, True otherwise
+    '''
+    partfile = outputfile + '.part'
+    etagfile = outputfile + '.etag'
+    if not keep:
+        remove_files([outputfile, partfile, etagfile])
+    response = pool.request('HEAD', url)
+    response.read()
+    if response.status != 200:
+        raise IOError('HEAD ' + url + ' returned ' + str(response.status))
+    length = response.getheader('content-length')
+    length = int(length) if length is not None else None
+    etag = response.getheader('etag')
+    stored_etag = read_etag(etagfile)
+    if os.path.exists(outputfile):
+        if (length is not None and os.path.getsize(outputfile) == length and
+                (etag is None or stored_etag in [None, etag])):
+            return False
+        # outdated or incomplete file
+        remove_files([outputfile])
+    headers = {}
+    if os.path.exists(partfile) and etag is not None and stored_etag == etag:
+        # resume the partial download if the file on the server is the same
+        headers = {'Range': 'bytes=%i-' % os.path.getsize(partfile),
+                   'If-Range': etag}
+    else:
+        remove_files([partfile, etagfile])
+        if etag is not None:
+            with open(etagfile, 'w') as fp:
+                fp.write(etag)
+    response = pool.request('GET', url, headers=headers)
+    if response.status == 206:
+        mode = 'ab'
+    elif response.status == 200:
+        mode = 'wb'
+    elif response.status == 416 and os.path.getsize(partfile) == length:
+        # partial download was already complete
+        response.read()
+        mode = None
+    else:
+        response.read()
+        raise IOError('GET ' + url + ' returned ' + str(response.status))
+    if mode is not None:
+        with open(partfile, mode) as output:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                output.write(chunk)
+    if length is not None and os.path.getsize(partfile) != length:
+        raise IOError('Incomplete download of ' + url + ': ' +
+                      str(os.path.getsize(partfile)) + ' of ' + str(length) +
+                      ' bytes')
+    os.rename(partfile, outputfile)
+    return True
+
+
+def thread_map(func, items, threads=4, cleanup=None):
+    '''
+    apply func to all items using a bounded number of threads
+    results are returned in the order of items, the first exception raised
+    by func is raised again after all threads are finished
+    cleanup (if given) is called by each thread when it is done
+    '''
+    queue = Queue.Queue()
+    for idx, item in enumerate(items):
+        queue.put((idx, item))
+    results = [None] * len(items)
+    errors = []
+
+    def worker():
+        try:
+            while True:
+                try:
+                    idx, item = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[idx] = func(item)
+                except Exception:
+                    errors.append(sys.exc_info()[1])
+        finally:
+            if cleanup is not None:
+                cleanup()
+
+    workers = [threading.Thread(target=worker) for idx in
+               range(max(1, min(threads, len(items))))]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def download_files(jobs, threads=4, keep=True):
+    '''
+    download a list of (url, outputfile) tuples using a bounded number of
+    threads, each thread reuses its connections for all of its downloads
+    returns the list of urls that could not be downloaded
+    '''
+    pool = connection_pool()
+
+    def download(job):
+        url, outputfile = job
+        try:
+            if download_file(pool, url, outputfile, keep=keep):
+                logger.info('Downloaded ' + url)
+            else:
+                logger.info('Up to date ' + outputfile)
+        except (IOError, OSError, httplib.HTTPException) as e:
+            logger.error('Error downloading file ' + url + ': ' + str(e))
+            return url
+
+    results = thread_map(download, jobs, threads=threads, cleanup=pool.close)
+    return [url for url in results if url is not None]
+
+
+def write_atomic(filename, data):
+    '''
+    write data to a temporary file that is renamed to filename
+    '''
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmpfile, filename)
+    except:
+        os.remove(tmpfile)
+        raise
+
+
+class page_cache:
+    '''
+    on-disk cache of web pages keyed by url
+    pages that were fetched less than ttl seconds ago are read from disk,
+    older pages are revalidated with If-None-Match/If-Modified-Since
+    '''
+    def __init__(self, cachedir, ttl=86400, pool=None):
+        self.cachedir = cachedir
+        self.ttl = ttl
+        self.pool = pool if pool is not None else connection_pool()
+        if not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def filenames(self, url):
+        '''
+        return the names of the page and metadata file of url in the cache
+        '''
+        key = os.path.join(self.cachedir, hashlib.sha1(url).hexdigest())
+        return key + '.html', key + '.json'
+
+    def get(self, url):
+        '''
+        return the content of url, from the cache if possible
+        '''
+        pagefile, metafile = self.filenames(url)
+        try:
+            with open(metafile, 'r') as fp:
+                meta = json.load(fp)
+            with open(pagefile, 'rb') as fp:
+                page = fp.read()
+        except (IOError, ValueError):
+            meta, page = None, None
+        if meta is not None and time.time() - meta['fetched'] < self.ttl:
+            return page
+        headers = {}
+        if meta is not None and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta is not None and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        response = self.pool.request('GET', url, headers=headers)
+        content = response.read()
+        if response.status == 304 and meta is not None:
+            logger.debug('Not modified ' + url)
+        elif response.status == 200:
+            page = content
+            meta = {'url': url, 'etag': response.getheader('etag'),
+                    'last_modified': response.getheader('last-modified')}
+            write_atomic(pagefile, page)
+        else:
+            raise IOError('GET ' + url + ' returned ' + str(response.status))
+        meta['fetched'] = time.time()
+        write_atomic(metafile, json.dumps(meta))
+        return page
@@ -13,45 +13,90 @@ from numpy import concatenate as npconcatenate
 import csv
 import os
 
-def read_knmi_data(reference_station):
+def read_knmi_data(reference_station, since=None):
     '''
-    Calculate or load KNMI reference data:
-        pickled file exists -> load
-        pickled file doesn't exist -> calculate
+    Load all KNMI zip files of a reference station and merge them into a
+    single dictionary with all variables/time steps
+    If since (datetime64) is given, zip files that end (according to the
+    year range in the filename) before since are skipped.
     '''
     from load_knmi_data import load_knmi_data
     import glob
     from numpy import sort
-    from numpy import concatenate
-    import collections
     # generate filename of KNMI station
     filenames = sort(glob.glob('KNMI/uurgeg_' + str(reference_station) + '*.zip' ))
+    if since is not None:
+        since_year = since.astype('datetime64[Y]').astype(int) + 1970
+        filenames = [filename for filename in filenames if
+                     last_year(filename) >= since_year]
     # load all csv files in list of dictionaries
     dicts = [load_knmi_data(filename).csvdata for filename in filenames]
-    # merge all dictionaries in a super dictionary
-    knmi_data = collections.defaultdict(list)
-    for idx in range(0,len(dicts)):
-      try:
-        knmi_data = dict((k, npconcatenate((knmi_data.get(k), dicts[idx].get(k)))) for k in set(knmi_data.keys() + dicts[idx].keys()))
-      except ValueError:
-        # cannot concatenate empty arrays
-        knmi_data = dict((k, dicts[idx].get(k)) for k in dicts[idx].keys())
     # return dictionary with all variables/time steps
+    return merge_station_data(dicts)
+
+def last_year(filename):
+    '''
+    return the last year in a KNMI filename like uurgeg_260_2011-2020.zip,
+    files without a year range in the filename are never skipped
+    '''
+    import re
+    match = re.search(r'_(\d{4})-(\d{4})\.zip$', filename)
+    if match is None:
+        return float('inf')
+    return int(match.group(2))
+
+def merge_station_data(dicts, timekey='datetime'):
+    '''
+    Merge a list of column dictionaries (one per file, in file order):
+        - every column is concatenated exactly once
+        - columns missing in a file are filled with -999
+        - the result is sorted on timekey
+        - duplicate timestamps keep the values of the latest file
+    The per-file columns are released while merging, so peak memory stays
+    close to twice the size of the merged data.
+    '''
+    from numpy import append as npappend
+    from numpy import full
+    dicts = [d for d in dicts if len(d.get(timekey, [])) > 0]
+    if not dicts:
+        return {}
+    lengths = [len(d[timekey]) for d in dicts]
+    # merge the time axis first, it defines the order of all other columns
+    times = npconcatenate([d.pop(timekey) for d in dicts])
+    index = None
+    if not (times[1:] > times[:-1]).all():
+        # stable sort: for equal timestamps the latest file comes last
+        order = times.argsort(kind='mergesort')
+        times = times[order]
+        # keep the last occurrence of each timestamp
+        keep = npappend(times[1:] != times[:-1], True)
+        index = order[keep]
+        times = times[keep]
+    knmi_data = {timekey: times}
+    keys = set().union(*[d.keys() for d in dicts])
+    for key in keys:
+        dtype = [d[key] for d in dicts if key in d][0].dtype
+        column = npconcatenate([d.pop(key) if key in d else
+                                full(length, -999, dtype=dtype)
+                                for d, length in zip(dicts, lengths)])
+        knmi_data[key] = column if index is None else column[index]
     return knmi_data
 
-def write_combined_data_netcdf(data, stationid, lon, lat, elevation):
+def write_combined_data_netcdf(data, stationid, lon, lat, elevation,
+                               filename=None, scale_factors=None):
   '''
-  description
+  write station data to netcdf file filename (default: output<stationid>.nc)
+  scale_factors is an optional dictionary variable -> scale_factor used to
+  pack variables to integers
   '''
   from netCDF4 import Dataset as ncdf
-  import netcdftime
-  from datetime import datetime
-  from dateutil import tz
-  from numpy import zeros
-  from numpy import nan as npnan
   from numpy import dtype
+  from ncwriter import write_time
+  from ncwriter import write_variables
   import time
-  ncfile = ncdf('output'+str(stationid)+'.nc', 'w', format='NETCDF4')
+  if filename is None:
+    filename = 'output' + str(stationid) + '.nc'
+  ncfile = ncdf(filename, 'w', format='NETCDF4')
   # description of the file
   ncfile.description = 'KNMI ' + str(stationid)
   ncfile.history = 'Created ' + time.ctime(time.time())
@@ -62,17 +107,8 @@ def write_combined_data_netcdf(data, stationid, lon, lat, elevation):
   latvar = ncfile.createDimension('latitude', 1)
   # elevation
   elvar = ncfile.createDimension('elevation', 1)
-  # inititalize time axis
-  timeaxis = [int(round(netcdftime.date2num(data['datetime'][idx], units='minutes since 2010-01-01 00:00:00',
-                                 calendar='gregorian'))) for idx in range(0,len(data['datetime']))]
   # netcdf time variable UTC
-  timevar = ncfile.createVariable('time', 'i4', ('time',),
-                                  zlib=True)
-  timevar[:] = timeaxis
-  timevar.units = 'minutes since 2010-01-01 00:00:00'
-  timevar.calendar = 'gregorian'
-  timevar.standard_name = 'time'
-  timevar.long_name = 'time in UTC'
+  timevar = write_time(ncfile, data['datetime'])
 
   # lon/lat variables
   lonvar = ncfile.createVariable('longitude',dtype('float32').char,('longitude',))
@@ -94,33 +130,10 @@ def write_combined_data_netcdf(data, stationid, lon, lat, elevation):
   elvar[:] = elevation
   
   # create other variables in netcdf file
-  for variable in data.keys():
-    if variable not in ['YYYMMDD', 'Time', '<br>', 'datetime', '# STN', None]:
-      # add variables in netcdf file
-      # convert strings to npnan if array contains numbers
-      if True in [is_number(c)
-        for c in data[variable]]:
-          data[variable] = [npnan if isinstance(
-            fitem(c), str) else fitem(c) for c in data[
-              variable]]
-      # check if variable is a string
-      if not isinstance(data[variable][1], str):
-          # fill variable
-          variableName = variable
-          values = ncfile.createVariable(
-            variableName, type(data[variable][1]),
-            ('time',), zlib=True, fill_value=-999)
-      else:
-        # string variables cannot have fill_value
-        values = ncfile.createVariable(
-          variable, type(data[variable][1]),
-          ('time',), zlib=True)
-      try:  # fill variable
-        values[:] = data[variable][:]
-      except IndexError:
-        # for strings the syntax is slightly different
-        values = data[variable][:]
-        #self.fill_attribute_data()
+  write_variables(ncfile, data, exclude=['YYYMMDD', 'Time', '<br>', 'datetime',
+                                         '# STN'],
+                  scale_factors=scale_factors)
+  ncfile.close()
 
 
 def fill_attribute_data():
@@ -139,67 +152,187 @@ def fill_attribute_data():
     pass
 
 
-def fitem(item):
-    try:
-        item = item.strip()
-    except AttributeError:
-        pass
-    try:
-        item = float(item)
-    except ValueError:
-        pass
-    return item
+class station_catalogue:
+    '''
+    typed station information from a csv file with a header row:
+        - table: structured array with one record per station, columns
+                 that only contain integers/floats are stored as such
+        - index: dictionary station_id -> row in table
+    iterating over the catalogue yields the station ids in file order,
+    catalogue[station_id] returns the record of a station in O(1)
+    '''
+    def __init__(self, csvfile):
+        from numpy import array
+        from numpy import empty
+        with open(csvfile, 'r') as csvin:
+            reader = csv.reader(csvin, delimiter=',')
+            header = [name.strip() for name in next(reader)]
+            rows = [row for row in reader if row]
+        columns = [array([value.strip() for value in column]) for column in
+                   zip(*rows)] if rows else [array([])] * len(header)
+        dtypes = [self.column_dtype(column) for column in columns]
+        self.table = empty(len(rows), dtype=list(zip(header, dtypes)))
+        for name, column in zip(header, columns):
+            self.table[name] = column.astype(self.table.dtype[name])
+        self.index = dict((station, idx) for idx, station in
+                          enumerate(self.table[header[0]].tolist()))
 
+    @staticmethod
+    def column_dtype(column):
+        '''
+        return the dtype of a column of strings: int64, float64 or string
+        '''
+        for dtype, convert in [('i8', int), ('f8', float)]:
+            try:
+                [convert(value) for value in column]
+                return dtype
+            except ValueError:
+                pass
+        return 'S%i' % max([len(value) for value in column] + [1])
+
+    def __getitem__(self, station):
+        return self.table[self.index[station]]
+
+    def __contains__(self, station):
+        return station in self.index
+
+    def __iter__(self):
+        return iter(self.table[self.table.dtype.names[0]].tolist())
 
-def is_number(s):
+    def __len__(self):
+        return len(self.table)
+
+
+# loaded station catalogues: csvfile -> (modification time, catalogue)
+station_catalogues = {}
+
+
+def load_station_catalogue(csvfile):
     '''
-    check if the value in the string is a number and return True or False
+    load the station information in csvfile, the catalogue is built once
+    and reused until the modification time of csvfile changes
     '''
+    csvfile = os.path.abspath(csvfile)
+    mtime = os.path.getmtime(csvfile)
+    if (csvfile not in station_catalogues or
+            station_catalogues[csvfile][0] != mtime):
+        station_catalogues[csvfile] = (mtime, station_catalogue(csvfile))
+    return station_catalogues[csvfile][1]
+
+
+def append_combined_data_netcdf(stationid, filename):
+  '''
+  append the time steps after the last time step in netcdf file filename,
+  only the zip files that can contain newer data are read
+  returns the number of appended time steps
+  '''
+  from netCDF4 import Dataset as ncdf
+  from ncwriter import append_variables
+  from ncwriter import last_time
+  import time
+  ncfile = ncdf(filename, 'a')
+  try:
+    data = read_knmi_data(stationid, since=last_time(ncfile))
+    if not data:
+      return 0
+    nsteps = append_variables(ncfile, data, 'datetime')
+    if nsteps > 0:
+      ncfile.history += '\nAppended ' + time.ctime(time.time())
+  finally:
+    ncfile.close()
+  return nsteps
+
+
+def convert_station(args):
+  '''
+  convert all data of a single station to output<station>.nc
+  the netcdf file is written to a temporary file that is renamed when
+  complete, so output<station>.nc is never left half written
+  in append mode an existing output<station>.nc is extended in place with
+  the time steps after its last time step
+  returns the station id, the elapsed time in seconds and an error
+  message (None if the conversion succeeded)
+  '''
+  import tempfile
+  import time
+  import traceback
+  station, lon, lat, elevation, append = args
+  start = time.time()
+  outputfile = 'output' + str(station) + '.nc'
+  if append and os.path.isfile(outputfile):
     try:
-        float(s)
-        return True
-    except ValueError:
-        pass
-    return False
+      append_combined_data_netcdf(station, outputfile)
+    except Exception:
+      return station, time.time() - start, traceback.format_exc()
+    return station, time.time() - start, None
+  fd, tmpfile = tempfile.mkstemp(prefix=outputfile + '.', suffix='.tmp',
+                                 dir=os.path.dirname(os.path.abspath(
+                                   outputfile)))
+  os.close(fd)
+  try:
+    data = read_knmi_data(station)
+    write_combined_data_netcdf(data, station, lon, lat, elevation,
+                               filename=tmpfile)
+    # mkstemp creates the file readable for the owner only
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmpfile, 0o666 & ~umask)
+    os.rename(tmpfile, outputfile)
+  except Exception:
+    if os.path.exists(tmpfile):
+      os.remove(tmpfile)
+    return station, time.time() - start, traceback.format_exc()
+  return station, time.time() - start, None
 
 
-def load_csv_data(csvfile):
-    '''
-    load data csvfile
-    '''
-    with open(csvfile, 'r') as csvin:
-        reader = csv.DictReader(csvin, delimiter=',')
-        try:
-            csvdata
-        except UnboundLocalError:
-            reader.next()
-            try:
-                csvdata = {k.strip(): [fitem(v)] for k, v in
-                                reader.next().items()}
-            except StopIteration:
-                pass
-        current_row = 0
-        for line in reader:
-            current_row += 1
-            if current_row == 0:  # header
-                # skip the header
-                continue
-            for k, v in line.items():
-                if k is not None:  # skip over empty fields
-                    k = k.strip()
-                    csvdata[k].append(fitem(v))
-    return csvdata
+def convert_stations(stations, workers=1):
+  '''
+  convert a list of (station, lon, lat, elevation, append) tuples using a pool of
+  worker processes, each worker converts a single station at a time
+  prints the timing of each station and returns a list of failed stations
+  '''
+  import multiprocessing
+  if workers > 1:
+    pool = multiprocessing.Pool(processes=min(workers, max(len(stations), 1)))
+    results = pool.imap_unordered(convert_station, stations)
+  else:
+    pool = None
+    results = (convert_station(station) for station in stations)
+  failed = []
+  try:
+    for station, seconds, error in results:
+      if error is None:
+        print ('station %s converted in %.1f s' % (station, seconds))
+      else:
+        print ('station %s failed after %.1f s:\n%s' % (station, seconds, error))
+        failed.append(station)
+  finally:
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+  return failed
 
 
 if __name__=="__main__":
-  knmi_csv_info = load_csv_data('knmi_reference_data.csv')
-  station_ids = [int(x) for x in knmi_csv_info['station_id']]
-  for station in station_ids:
-    if os.path.isfile('output' + str(station) + '.nc'):
+  import argparse
+  import multiprocessing
+  parser = argparse.ArgumentParser(description='Convert KNMI data to netCDF')
+  parser.add_argument('-c', '--csvfile', help='CSV file with station information',
+                      default='knmi_reference_data.csv', required=False)
+  parser.add_argument('-w', '--workers', help='Number of worker processes',
+                      default=multiprocessing.cpu_count(), type=int,
+                      required=False)
+  parser.add_argument('-a', '--append', help='Append new data to existing output files',
+                      required=False, action='store_true')
+  opts = parser.parse_args()
+  knmi_csv_info = load_station_catalogue(opts.csvfile)
+  stations = []
+  for station in knmi_csv_info:
+    if os.path.isfile('output' + str(station) + '.nc') and not opts.append:
       continue
-    print (station)
-    lat = knmi_csv_info['latitude'][station_ids.index(station)]
-    lon = knmi_csv_info['longitude'][station_ids.index(station)]
-    elevation = knmi_csv_info['elevation'][station_ids.index(station)]
-    data = read_knmi_data(station)
-    write_combined_data_netcdf(data, station, lon, lat, elevation)
+    info = knmi_csv_info[station]
+    stations.append((station, info['longitude'], info['latitude'],
+                     info['elevation'], opts.append))
+  failed = convert_stations(stations, workers=opts.workers)
+  if failed:
+    print ('conversion failed for stations: ' + ', '.join(str(x) for x in failed))
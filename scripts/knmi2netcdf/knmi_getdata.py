@@ -11,16 +11,20 @@ Notes:          -
 '''
 
 from lxml.html import parse
+import StringIO
 import csv
-import urllib2
 from lxml import html
 import numbers
 import json
 import os
 import utils
-from numpy import vstack
+import httpclient
 import argparse
 
+# web pages with station metadata and download links
+METADATA_URL = 'http://projects.knmi.nl/klimatologie/metadata/index.html'
+DOWNLOAD_URL = 'http://www.knmi.nl/nederland-nu/klimatologie/uurgegevens'
+
 
 class get_knmi_reference_data:
     '''
@@ -30,23 +34,39 @@ class get_knmi_reference_data:
         self.csvfile = opts.csvfile
         self.outputdir = opts.outputdir
         self.keep = opts.keep
+        self.threads = opts.threads
+        self.metadata_url = opts.metadata_url
+        self.download_url = opts.download_url
         self.check_output_dir()
+        # web pages are cached on disk and revalidated after ttl seconds
+        self.cache = httpclient.page_cache(opts.cachedir, ttl=opts.ttl)
         self.station = opts.stationid
         self.get_station_ids()
         print (self.stationids)
         self.download_station_data()
         self.get_station_locations()
 
+    def parse_page(self, url):
+        '''
+        parse a (cached) web page
+        '''
+        return parse(StringIO.StringIO(self.cache.get(url)), base_url=url)
+
     def get_station_ids(self):
         '''
         get all stationids from the KNMI website
         '''
         import re
-        url = 'http://projects.knmi.nl/klimatologie/metadata/index.html'
-        page = parse(url)
+        page = self.parse_page(self.metadata_url)
         url_metadata = page.xpath(".//table/tr/td/a/@href")
         station_name_id = [c.text for c in page.xpath(".//table/tr/td/a")]
         stationids = [s.split()[0] for s in station_name_id]
+        # station id, station name and metadata url of all stations
+        self.station_index = [
+            (stationids[idx], " ".join(station_name_id[idx].split()[1:]),
+             os.path.join(os.path.split(self.metadata_url)[0],
+                          url_metadata[idx]))
+            for idx in range(0, len(stationids))]
         bad_chars = '(){}<>'
         self.rgx = re.compile('[%s]' % bad_chars)
         station_names = [re.sub(self.rgx, '', " ".join(s.split()[1:])) for s in station_name_id]
@@ -62,58 +82,49 @@ class get_knmi_reference_data:
         ''''
         download zip files containing csv station data
         (complete time series for all KNMI stations)
+        files are downloaded concurrently and partial downloads are resumed
+        if keep is set
         '''
         import re
-        url = 'http://www.knmi.nl/nederland-nu/klimatologie/uurgegevens'
-        page = parse(url)
+        page = self.parse_page(self.download_url)
         # find location of stations on web page
         num_stations = len(page.xpath("/html/body/main/div[2]/div"))
         station_elements = [page.xpath("/html/body/main/div[2]/div["+str(idx)+"]/div/div/div[2]/table/thead/tr/th") for idx in range(0,num_stations)]
         station_names = [re.sub(self.rgx, '', x[0].text) if len(x)>0 else 'ndf'
                          for x in station_elements]
+        jobs = []
         for stationid in self.stationids:
             div_id = str(station_names.index(stationid))
             relpaths = page.xpath("/html/body/main/div[2]/div["+div_id+"]/div/div/div[2]/table/tbody/tr/td/a/@href")
             for path in relpaths:
-                try:
-                    fullpath = "http:" + path
-                    request = urllib2.urlopen(fullpath)
-                    filename = os.path.basename(path)
-                    outputfile = os.path.join(self.outputdir, filename)
-                    if self.keep:
-                        if os.path.exists(outputfile):
-                            # check if filesize is not null
-                            if os.path.getsize(outputfile) > 0:
-                                # file exists and is not null, continue next iteration
-                                continue
-                            else:
-                                # file exists but is null, so remove and redownload
-                                os.remove(outputfile)
-                    elif os.path.exists(outputfile):
-                        os.remove(outputfile)
-                    #save
-                    output = open(outputfile, "w")
-                    output.write(request.read())
-                    output.close()
-                except urllib2.HTTPError:
-                      print "Error downloading file " + fullpath
+                fullpath = "http:" + path
+                filename = os.path.basename(path)
+                jobs.append((fullpath, os.path.join(self.outputdir, filename)))
+        # download all files using a bounded number of threads
+        failed = httpclient.download_files(jobs, threads=self.threads,
+                                           keep=self.keep)
+        for fullpath in failed:
+            print ("Error downloading file " + fullpath)
 
 
     def get_station_locations(self):
         '''
         write station name, id and location to csv file
+        only the requested station is written if a stationid is given
         '''
-        # get station names for stationids
-        url = 'http://projects.knmi.nl/klimatologie/metadata/index.html'
-        page = parse(url)
-        url_metadata = page.xpath(".//table/tr/td/a/@href")
-        station_name_id = [c.text for c in page.xpath(".//table/tr/td/a")]
-        station_id = [s.split()[0] for s in station_name_id]
-        station_names = [" ".join(s.split()[1:]) for s in station_name_id]
-        for idx, stationid in enumerate(station_id):
-            station_url = os.path.join(os.path.split(url)[0],
-                                       url_metadata[idx])
-            page = parse(station_url)
+        stations = [station for station in self.station_index if
+                    len(self.station) == 0 or station[0] == self.station]
+        # fetch the metadata pages of all stations in parallel, each thread
+        # closes its persistent connections when it is done
+        pages = httpclient.thread_map(self.parse_page,
+                                      [station[2] for station in stations],
+                                      threads=self.threads,
+                                      cleanup=self.cache.pool.close)
+        station_id = [station[0] for station in stations]
+        station_names = [station[1] for station in stations]
+        stations_out = []
+        for idx, page in enumerate(pages):
+            station_url = stations[idx][2]
             rows = [c.text for c in page.xpath(".//table/tr/td")]
             idx_position = rows.index('Positie:') + 1
             idx_startdate = rows.index('Startdatum:') + 1
@@ -123,18 +134,29 @@ class get_knmi_reference_data:
             lat,lon = self.latlon_conversion(lat,lon)
             idx_elevation = rows.index('Terreinhoogte:') + 1
             elevation = float(rows[idx_elevation].encode('UTF-8').split(' ')[0].replace(',','.'))
-
-            try:
-                dataout = vstack((dataout,
-                                 [station_id[idx], station_names[idx],
-                                  lat, lon, elevation, station_url]))
-            except NameError:
-                dataout = [station_id[idx], station_names[idx],
-                           lat, lon, elevation, station_url]
-        header = ['station_id', 'station_name','latitude', 'longitude', 'elevation', 'url']
-        dataout = vstack((header, dataout))
+            stations_out.append((int(station_id[idx]),
+                                 station_names[idx].encode('UTF-8'),
+                                 lat, lon, elevation, station_url))
+        dataout = self.station_table(stations_out)
         # write to csv file
-        utils.write_csvfile(self.csvfile, dataout)
+        utils.write_csvfile(self.csvfile, dataout.tolist(),
+                            header=dataout.dtype.names)
+
+    def station_table(self, stations):
+        '''
+        convert a list of (station_id, station_name, latitude, longitude,
+        elevation, url) tuples to a structured array sorted on station_id
+        '''
+        from numpy import array
+        name_length = max([len(station[1]) for station in stations] + [1])
+        url_length = max([len(station[5]) for station in stations] + [1])
+        table = array(stations, dtype=[('station_id', 'i4'),
+                                       ('station_name', 'S%i' % name_length),
+                                       ('latitude', 'f8'),
+                                       ('longitude', 'f8'),
+                                       ('elevation', 'f8'),
+                                       ('url', 'S%i' % url_length)])
+        return table[table['station_id'].argsort(kind='mergesort')]
 
     def latlon_conversion(self, lat, lon):
         '''
@@ -170,6 +192,17 @@ if __name__ == "__main__":
                         required=True, action='store')
     parser.add_argument('-k', '--keep', help='Keep downloaded files',
                         required=False, action='store_true')
+    parser.add_argument('-n', '--threads', help='Number of concurrent downloads',
+                        default=4, type=int, required=False)
+    parser.add_argument('--cachedir', help='Cache directory for web pages',
+                        default=os.path.join(os.getcwd(), '.knmi_cache'),
+                        required=False)
+    parser.add_argument('--ttl', help='Time in seconds before cached web pages are revalidated',
+                        default=86400, type=int, required=False)
+    parser.add_argument('--metadata-url', help='Station metadata index page',
+                        default=METADATA_URL, required=False)
+    parser.add_argument('--download-url', help='Station data download page',
+                        default=DOWNLOAD_URL, required=False)
     parser.add_argument('-l', '--log', help='Log level',
                         choices=utils.LOG_LEVELS_LIST,
                         default=utils.DEFAULT_LOG_LEVEL)
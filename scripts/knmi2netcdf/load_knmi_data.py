@@ -6,83 +6,119 @@ class load_knmi_data:
         
     def load_file(self):
         '''
-        function description
+        read the txt file inside the zip file in a single pass into typed
+        numpy columns, one column per header field
+        empty fields are filled with -999
         '''
-        import zipfile
-        import csv
         import os
-        import StringIO
-        from numpy import vstack
-        # load the zip file
-        zipf = zipfile.ZipFile(self.filename)
+        from zipreader import read_members
         # name of csv name in zip file
         txtname = os.path.splitext(os.path.basename(self.filename))[0] + '.txt'
-        # read the data in the txt file
-        data = StringIO.StringIO(zipf.read(txtname))
-        reader = csv.reader(data)
-        # file content is ignored while start_data==False
-        start_data = False
-        # loop through all rows of the txt file
-        for row in reader:
-            if not start_data:
-                if '# STN' in row:  # look for header definition in csv file
-                    header = [item.strip() for item in row]
-                    # found the header
-                    # set start_data = True ==>> use content from here
-                    start_data = True
-            else:
-                # we found the header definition, data starts from here
-                if len(row) > 0:
-                    # strip data in row and convert to int
-                    # empty fiels are filled with -999
-                    try:
-                        data_row = [int(item.strip()) if item.strip()
-                                    else -999 for item in row if item]
-                    except ValueError:
-                        import pdb; pdb.set_trace()
-                    # create array with output data
-                    try:
-                        csvdata = vstack((csvdata, data_row))
-                    except UnboundLocalError:
-                        csvdata = data_row
+        self.csvdata = read_members(self.filename,
+                                    [(txtname, self.read_member)])[0]
+        if self.csvdata is None:
+            raise KeyError(txtname + ' not found in ' + self.filename)
+
+    def read_member(self, member, info):
+        '''
+        stream the txt file from the zip file in fixed size blocks and
+        return a dictionary with a column for every header field
+        '''
+        from zipreader import iter_lines
+        data = iter_lines(member)
+        header = self.read_header(data)
+        # uncompressed size of the txt file, used to estimate number of rows
+        columns, nrows = self.read_columns(data, len(header), info.file_size)
         # create a dictionary from the header and output data
-        self.csvdata = dict(zip(header, csvdata.T))
+        return dict((name, columns[idx, :nrows]) for idx, name in
+                    enumerate(header))
+
+    def read_header(self, data):
+        '''
+        skip file content until the header definition is found and
+        return the stripped header fields
+        '''
+        for line in data:
+            if '# STN' in line:  # look for header definition in csv file
+                return [item.strip() for item in line.split(',')]
+        raise ValueError('No header definition found in ' + self.filename)
+
+    def read_columns(self, data, ncols, filesize):
+        '''
+        read all data rows into a preallocated (ncols, nrows) int32 array,
+        each row of the array holds a single column of the txt file
+        the array grows geometrically if the row estimate is too small
+        '''
+        from numpy import empty
+        columns = None
+        nrows = 0
+        for lineno, line in enumerate(data):
+            if not line.strip():
+                continue  # skip empty lines
+            # empty fields are filled with -999
+            try:
+                values = [int(item) if item.strip() else -999 for item in
+                          line.rstrip('\r\n').split(',')[:ncols]]
+            except ValueError:
+                raise ValueError('Cannot convert data row ' + str(lineno) +
+                                 ' in ' + self.filename + ': ' + line)
+            if len(values) != ncols:
+                raise ValueError('Incomplete data row ' + str(lineno) +
+                                 ' in ' + self.filename + ': ' + line)
+            if columns is None:
+                # estimate number of rows from the size of the first row
+                columns = empty((ncols, filesize // len(line) + 1),
+                                dtype='int32')
+            elif nrows == columns.shape[1]:
+                # estimate was too small, double the capacity
+                grown = empty((ncols, 2 * nrows), dtype='int32')
+                grown[:, :nrows] = columns
+                columns = grown
+            columns[:, nrows] = values
+            nrows += 1
+        if columns is None:
+            columns = empty((ncols, 0), dtype='int32')
+        return columns, nrows
 
     def process_reference_data(self):
         '''
         process the reference csv data
+        all conversions are numpy array operations, missing values (-999)
+        are kept as -999
         '''
-        from datetime import datetime
-        from datetime import date
-        from datetime import timedelta
-        from numpy import zeros
-        ## Convert time to datetime.datetime object
+        from numpy import where
+        from derived import wind_uv
+        from utils import datetime_axis
+        ## Convert time to numpy.datetime64 objects
         # hours should be 0-23 instead of 1-24
-        self.csvdata['HH'] = [item if item!=24 else 0 for item in
-                              self.csvdata['HH']]
-        # combine date and hour into one string
-        dstring = [str(self.csvdata['YYYYMMDD'][idx]) +
-                   str(self.csvdata['HH'][idx]).zfill(2) for idx in
-                   range(0,len(self.csvdata['YYYYMMDD']))]
-        # create datetime object
-        self.csvdata['datetime'] = [datetime.strptime(
-            str(item), ('%Y%m%d%H')) for item in dstring]
-        # Correct conversion of the datestring
         # the date of the night -> HH=24 is HH=0 on the next day!
-        self.csvdata['datetime'] = [c+ timedelta(days=1) if c.hour==0 else
-                                    c for c in self.csvdata['datetime']]
+        self.csvdata['datetime'] = datetime_axis(
+            self.csvdata['YYYYMMDD'], self.csvdata['HH'])
+        self.csvdata['HH'] = where(self.csvdata['HH'] == 24, 0,
+                                   self.csvdata['HH'])
         # rain is (-1 for <0.05 mm), set to 0
-        self.csvdata['RH'] = [0 if item == -1 else
-                                  item for item in self.csvdata['RH']]
+        self.csvdata['RH'] = where(self.csvdata['RH'] == -1, 0,
+                                   self.csvdata['RH'])
         # process all variables that need to be divided by 10
         for variable in ['T10', 'T', 'RH', 'FF', 'TD']:
             # T10: temperature at 10 cm height, divide by 10 to convert to degC
             # T: temperature at 1.50 m height, divide by 10 to convert to degC
             # RH: rain
             # FF: wind speed
-            self.csvdata[variable] = [round(0.1 * item, 1) if item != -999 else
-                                item for item in self.csvdata[variable]]
+            self.csvdata[variable] = self.scale(self.csvdata[variable], 0.1, 1)
         # SWD
-        self.csvdata['Q'] = [round(float(10000 * item)/3600, 5) if
-                             item != -999 else item for item in
-                             self.csvdata['Q']]
+        self.csvdata['Q'] = self.scale(self.csvdata['Q'], 10000. / 3600, 5)
+        # U and V wind components, DD=990 (variable) is treated as missing
+        self.csvdata['wind_u'], self.csvdata['wind_v'] = wind_uv(
+            self.csvdata['FF'], self.csvdata['DD'])
+
+    @staticmethod
+    def scale(values, factor, decimals, fill_value=-999):
+        '''
+        multiply values by factor and round to the given number of decimals,
+        values equal to fill_value are not scaled
+        '''
+        from numpy import where
+        from numpy import round as npround
+        return where(values == fill_value, fill_value,
+                     npround(factor * values, decimals))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Shared netCDF writer for typed station data columns:
+                    * compact_dtype(values, fill_value=FILL_VALUE)
+                    * pack(values, scale_factor, fill_value=FILL_VALUE)
+                    * time_chunksizes(ncfile, chunksize=TIME_CHUNKSIZE)
+                    * write_variable(ncfile, name, values, ...)
+                    * write_variables(ncfile, data, exclude, ...)
+                    * encode_time(times, units=TIME_UNITS)
+                    * write_time(ncfile, times, chunksize=TIME_CHUNKSIZE)
+                    * decode_time(values, units=TIME_UNITS)
+                    * last_time(ncfile)
+                    * append_variables(ncfile, data, timekey)
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:        -
+Last Modified:  -
+License:        Apache 2.0
+Notes:          Packing with scale_factor is off unless requested:
+                netcdf2littler applies the scale_factor before comparing
+                with the _FillValue, so packed missing values would not be
+                recognized there.
+'''
+
+from numpy import asarray
+from numpy import datetime64
+from numpy import dtype
+from numpy import full
+from numpy import iinfo
+from numpy import isnan
+from numpy import round as npround
+from numpy import where
+
+# missing values in the station data
+FILL_VALUE = -999
+# chunk size along the time dimension (one year of hourly data)
+TIME_CHUNKSIZE = 8760
+# units of the time axis
+TIME_UNITS = 'minutes since 2010-01-01 00:00:00'
+# seconds per unit of time
+TIME_STEPS = {'seconds': 1, 'minutes': 60, 'hours': 3600, 'days': 86400}
+
+
+def compact_dtype(values, fill_value=FILL_VALUE):
+    '''
+    return the smallest dtype that holds all values and fill_value:
+        integer valued data -> int16, int32 or int64
+        other floating point data -> float32
+    used for integer source columns and packed data, floating point source
+    columns are always stored as float32 (see write_variable)
+    '''
+    values = asarray(values)
+    valid = values[values != fill_value]
+    if values.dtype.kind == 'f':
+        valid = valid[~isnan(valid)]
+        if not (valid == npround(valid)).all():
+            return dtype('float32')
+    elif values.dtype.kind not in 'iub':
+        raise TypeError('Cannot store dtype ' + str(values.dtype) +
+                        ' as a numeric variable')
+    low = min(valid.min(), fill_value) if valid.size else fill_value
+    high = max(valid.max(), fill_value) if valid.size else fill_value
+    for candidate in ['int16', 'int32', 'int64']:
+        if iinfo(candidate).min <= low and high <= iinfo(candidate).max:
+            return dtype(candidate)
+    return dtype('float64')
+
+
+def pack(values, scale_factor, fill_value=FILL_VALUE):
+    '''
+    pack values to integers with the given scale_factor,
+    missing values (fill_value or nan) are stored as fill_value
+    '''
+    values = asarray(values, dtype='float64')
+    missing = (values == fill_value) | isnan(values)
+    packed = where(missing, fill_value, npround(values / scale_factor))
+    return packed.astype(compact_dtype(packed, fill_value))
+
+
+def time_chunksizes(ncfile, chunksize=TIME_CHUNKSIZE):
+    '''
+    chunk sizes of a variable along the time dimension of ncfile
+    the unlimited time dimension always uses chunksize, the first write may
+    be short (e.g. a new station) but the chunks are kept for every append
+    '''
+    dimension = ncfile.dimensions['time']
+    if dimension.isunlimited():
+        return (chunksize,)
+    return (max(1, min(chunksize, len(dimension))),)
+
+
+def write_variable(ncfile, name, values, scale_factor=None,
+                   chunksize=TIME_CHUNKSIZE, fill_value=FILL_VALUE):
+    '''
+    create variable name along the time dimension of ncfile and fill it
+    with values in a single call
+    integer columns use the most compact integer dtype, floating point
+    columns are stored as float32 so the dtype of a variable does not depend
+    on the data (appended values may be fractional)
+    if scale_factor is given, the data is packed to integers
+    '''
+    values = asarray(values)
+    chunksizes = time_chunksizes(ncfile, chunksize)
+    if values.dtype.kind in 'SUO':
+        # string variables cannot have fill_value or compression
+        ncvar = ncfile.createVariable(name, str, ('time',),
+                                      chunksizes=chunksizes)
+        ncvar[:] = values.astype(object)
+        return ncvar
+    if values.dtype.kind == 'f':
+        values = where(isnan(values), fill_value, values)
+    if scale_factor is not None:
+        values = pack(values, scale_factor, fill_value)
+    elif values.dtype.kind == 'f':
+        values = values.astype('float32')
+    else:
+        values = values.astype(compact_dtype(values, fill_value))
+    ncvar = ncfile.createVariable(name, values.dtype, ('time',), zlib=True,
+                                  fill_value=fill_value,
+                                  chunksizes=chunksizes)
+    # values are written as is: fill_value marks missing data
+    ncvar.set_auto_maskandscale(False)
+    if scale_factor is not None:
+        ncvar.scale_factor = float(scale_factor)
+    ncvar[:] = values
+    return ncvar
+
+
+def write_variables(ncfile, data, exclude, scale_factors=None,
+                    chunksize=TIME_CHUNKSIZE, fill_value=FILL_VALUE):
+    '''
+    write all columns of data except the ones in exclude,
+    scale_factors is an optional dictionary variable -> scale_factor
+    '''
+    scale_factors = scale_factors or {}
+    for variable in sorted(key for key in data.keys() if key is not None):
+        if variable in exclude:
+            continue
+        write_variable(ncfile, variable, data[variable],
+                       scale_factor=scale_factors.get(variable),
+                       chunksize=chunksize, fill_value=fill_value)
+
+
+def encode_time(times, units=TIME_UNITS):
+    '''
+    convert a datetime64 array (or a sequence of datetime objects) to
+    integers in units '<seconds|minutes|hours|days> since <date>' in a
+    single array operation, rounded to the nearest unit
+    '''
+    step, reference = units.split(' since ')
+    reference = datetime64(reference.strip().replace(' ', 'T'), 's')
+    seconds = (asarray(times, dtype='datetime64[s]') -
+               reference).astype('int64')
+    return npround(seconds / float(TIME_STEPS[step.strip()])).astype('int32')
+
+
+def write_time(ncfile, times, chunksize=TIME_CHUNKSIZE):
+    '''
+    create the time variable (UTC, gregorian calendar) of ncfile
+    '''
+    timeaxis = encode_time(times)
+    timevar = ncfile.createVariable('time', 'i4', ('time',), zlib=True,
+                                    chunksizes=time_chunksizes(ncfile,
+                                                               chunksize))
+    timevar[:] = timeaxis
+    timevar.units = TIME_UNITS
+    timevar.calendar = 'gregorian'
+    timevar.standard_name = 'time'
+    timevar.long_name = 'time in UTC'
+    return timevar
+
+
+def decode_time(values, units=TIME_UNITS):
+    '''
+    convert integers in units '<unit> since <date>' to datetime64[s]
+    '''
+    step, reference = units.split(' since ')
+    reference = datetime64(reference.strip().replace(' ', 'T'), 's')
+    seconds = asarray(values, dtype='int64') * TIME_STEPS[step.strip()]
+    return reference + seconds.astype('timedelta64[s]')
+
+
+def last_time(ncfile):
+    '''
+    return the last time step of ncfile as datetime64[s],
+    None if the time dimension is empty
+    '''
+    timevar = ncfile.variables['time']
+    if len(timevar) == 0:
+        return None
+    return decode_time(timevar[-1:], timevar.units)[0]
+
+
+def append_variables(ncfile, data, timekey, fill_value=FILL_VALUE):
+    '''
+    append all time steps of data after the last time step of ncfile to
+    the time dimension, data is a dictionary of columns with the time axis
+    in data[timekey]
+    variables in ncfile that are missing in data are filled with fill_value
+    returns the number of appended time steps
+    '''
+    times = asarray(data[timekey], dtype='datetime64[s]')
+    last = last_time(ncfile)
+    new = slice(None) if last is None else times > last
+    times = times[new]
+    if len(times) == 0:
+        return 0
+    start = len(ncfile.variables['time'])
+    end = start + len(times)
+    # check all variables before writing anything
+    columns = {}
+    for name, ncvar in ncfile.variables.items():
+        if name == 'time' or ncvar.dimensions != ('time',):
+            continue
+        if ncvar.dtype == str:
+            # string variables have no fill_value
+            columns[name] = (asarray(data[name])[new].astype(object) if
+                             name in data else full(len(times), '', object))
+            continue
+        if name not in data:
+            columns[name] = full(len(times), fill_value, ncvar.dtype)
+            continue
+        values = asarray(data[name])[new]
+        if values.dtype.kind == 'f':
+            values = where(isnan(values), fill_value, values)
+        if 'scale_factor' in ncvar.ncattrs():
+            values = pack(values, ncvar.scale_factor, fill_value)
+        if (ncvar.dtype.kind in 'iu' and values.dtype.kind == 'f' and
+                (values != npround(values)).any()):
+            raise ValueError('New values of ' + name + ' are not integer ' +
+                             'valued and do not fit in ' + str(ncvar.dtype) +
+                             ', rewrite the file')
+        if ncvar.dtype.kind in 'iu' and values.size:
+            info = iinfo(ncvar.dtype)
+            if values.min() < info.min or values.max() > info.max:
+                raise ValueError('New values of ' + name + ' do not fit in ' +
+                                 str(ncvar.dtype) + ', rewrite the file')
+        columns[name] = values.astype(ncvar.dtype)
+    ncfile.variables['time'][start:end] = encode_time(
+        times, ncfile.variables['time'].units)
+    for name, values in columns.items():
+        ncvar = ncfile.variables[name]
+        # values are written as is: fill_value marks missing data
+        ncvar.set_auto_maskandscale(False)
+        ncvar[start:end] = values
+    return len(times)
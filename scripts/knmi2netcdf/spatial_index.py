@@ -0,0 +1,190 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Spatial index over station coordinates:
+                    * station_index(lon, lat, ids=None, cellsize=1.0)
+                        - query_radius(lon, lat, radius)
+                        - query_nearest(lon, lat, k=1)
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:        -
+Last Modified:  -
+License:        Apache 2.0
+Notes:          Stations are put in buckets of cellsize x cellsize degrees.
+                Queries are processed per bucket of query points: only the
+                stations in the surrounding buckets are candidates and their
+                distances are computed with a single vectorized haversine
+                call, so batch queries (e.g. all points of a WRF domain)
+                loop over buckets instead of points.
+'''
+
+from numpy import arange
+from numpy import arcsin
+from numpy import argsort
+from numpy import asarray
+from numpy import atleast_1d
+from numpy import ceil
+from numpy import concatenate
+from numpy import cos
+from numpy import degrees
+from numpy import floor
+from numpy import full
+from numpy import inf
+from numpy import pi
+from numpy import radians
+from numpy import sin
+from numpy import sort
+from numpy import unique
+from utils import haversine_array
+
+# earth radius in km, as used by utils.haversine
+EARTH_RADIUS = 6367.
+
+
+class station_index:
+    '''
+    grid bucket index for radius and k-nearest queries on stations
+    with great circle distances in km
+    '''
+    def __init__(self, lon, lat, ids=None, cellsize=1.0):
+        self.lon = asarray(lon, dtype='float64')
+        self.lat = asarray(lat, dtype='float64')
+        self.ids = asarray(ids) if ids is not None else None
+        self.cellsize = float(cellsize)
+        self.nrows = int(ceil(180. / self.cellsize)) + 1
+        self.ncols = int(ceil(360. / self.cellsize))
+        # sort the stations on bucket, each bucket is a slice of self.order
+        keys = self.cell_keys(self.lon, self.lat)
+        self.order = argsort(keys, kind='mergesort')
+        cells, start, counts = unique(keys[self.order], return_index=True,
+                                      return_counts=True)
+        self.cells = dict((key, (first, first + count)) for key, first, count
+                          in zip(cells.tolist(), start.tolist(),
+                                 counts.tolist()))
+
+    @classmethod
+    def from_catalogue(cls, catalogue, cellsize=1.0):
+        '''
+        create the index from a station catalogue (knmi2netcdf)
+        '''
+        table = catalogue.table
+        return cls(table['longitude'], table['latitude'],
+                   ids=table[table.dtype.names[0]], cellsize=cellsize)
+
+    def cell_rows_cols(self, lon, lat):
+        '''
+        return the bucket row and column of coordinates
+        '''
+        rows = floor((asarray(lat) + 90.) / self.cellsize).astype('int64')
+        cols = floor(((asarray(lon) + 180.) % 360.) /
+                     self.cellsize).astype('int64') % self.ncols
+        return rows, cols
+
+    def cell_keys(self, lon, lat):
+        '''
+        return a single integer bucket key for coordinates
+        '''
+        rows, cols = self.cell_rows_cols(lon, lat)
+        return rows * self.ncols + cols
+
+    def candidates(self, row, col, radius):
+        '''
+        return the indices of all stations that can be within radius km
+        of a point in bucket (row, col)
+        '''
+        dlat = degrees(radius / EARTH_RADIUS)
+        lat_low = row * self.cellsize - 90. - dlat
+        lat_high = (row + 1) * self.cellsize - 90. + dlat
+        rows = range(max(0, int(floor((lat_low + 90.) / self.cellsize))),
+                     min(self.nrows, int(floor((lat_high + 90.) /
+                                              self.cellsize)) + 1))
+        # maximum longitude difference within radius of a point in the
+        # bucket, reached at the bucket edge closest to a pole
+        max_lat = min(90., max(abs(row * self.cellsize - 90.),
+                               abs((row + 1) * self.cellsize - 90.)))
+        ratio = (sin(radians(min(dlat, 90.))) / cos(radians(max_lat)) if
+                 max_lat < 90. else inf)
+        if max_lat + dlat >= 90. or ratio >= 1.:
+            cols = range(self.ncols)
+        else:
+            dlon = degrees(arcsin(ratio))
+            dcols = int(ceil(dlon / self.cellsize))
+            if 2 * dcols + 1 >= self.ncols:
+                cols = range(self.ncols)
+            else:
+                cols = [(col + dcol) % self.ncols for dcol in
+                        range(-dcols, dcols + 1)]
+        slices = [self.cells[key] for key in
+                  [r * self.ncols + c for r in rows for c in cols]
+                  if key in self.cells]
+        if not slices:
+            return arange(0)
+        return sort(concatenate([self.order[first:last] for first, last in
+                                 slices]))
+
+    def query_buckets(self, lon, lat):
+        '''
+        group query points per bucket, yields (row, col, point indices)
+        '''
+        rows, cols = self.cell_rows_cols(lon, lat)
+        keys = rows * self.ncols + cols
+        order = argsort(keys, kind='mergesort')
+        buckets, start = unique(keys[order], return_index=True)
+        stop = concatenate([start[1:], [len(order)]])
+        for key, first, last in zip(buckets, start, stop):
+            yield key // self.ncols, key % self.ncols, order[first:last]
+
+    def query_radius(self, lon, lat, radius):
+        '''
+        return for every query point an array with the indices of the
+        stations within radius km, sorted on distance
+        '''
+        lon = atleast_1d(asarray(lon, dtype='float64'))
+        lat = atleast_1d(asarray(lat, dtype='float64'))
+        result = [None] * len(lon)
+        for row, col, points in self.query_buckets(lon, lat):
+            candidates = self.candidates(row, col, radius)
+            distances = haversine_array(lon[points][:, None],
+                                        lat[points][:, None],
+                                        self.lon[candidates][None, :],
+                                        self.lat[candidates][None, :])
+            for idx, point in enumerate(points):
+                inside = distances[idx] <= radius
+                result[point] = candidates[inside][
+                    argsort(distances[idx][inside], kind='mergesort')]
+        return result
+
+    def query_nearest(self, lon, lat, k=1):
+        '''
+        return (distances, indices) arrays of shape (npoints, k) with the
+        k nearest stations of every query point, sorted on distance
+        missing neighbours (fewer than k stations) have distance inf and
+        index -1
+        '''
+        lon = atleast_1d(asarray(lon, dtype='float64'))
+        lat = atleast_1d(asarray(lat, dtype='float64'))
+        distances = full((len(lon), k), inf)
+        indices = full((len(lon), k), -1, dtype='int64')
+        nstations = min(k, len(self.lon))
+        if nstations == 0:
+            return distances, indices
+        for row, col, points in self.query_buckets(lon, lat):
+            # grow the search radius until the k nearest stations of all
+            # points in the bucket are within the searched area
+            radius = self.cellsize * pi / 180. * EARTH_RADIUS
+            while True:
+                candidates = self.candidates(row, col, radius)
+                if len(candidates) >= nstations:
+                    dist = haversine_array(lon[points][:, None],
+                                           lat[points][:, None],
+                                           self.lon[candidates][None, :],
+                                           self.lat[candidates][None, :])
+                    nearest = argsort(dist, axis=1,
+                                      kind='mergesort')[:, :nstations]
+                    dist = dist[arange(len(points))[:, None], nearest]
+                    if ((dist[:, -1] <= radius).all() or
+                            radius >= pi * EARTH_RADIUS):
+                        break
+                radius *= 2
+            distances[points, :nstations] = dist
+            indices[points, :nstations] = candidates[nearest]
+        return distances, indices
@@ -0,0 +1,111 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Tests for appending data with ncwriter
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:        -
+Last Modified:  -
+License:        Apache 2.0
+Notes:          run with: python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from netCDF4 import Dataset
+from numpy import array
+from numpy import arange
+from numpy import testing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from ncwriter import TIME_CHUNKSIZE
+from ncwriter import append_variables
+from ncwriter import write_time
+from ncwriter import write_variables
+
+
+class test_append_variables(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'output.nc')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def hours(self, first, count):
+        return (arange(first, first + count).astype('datetime64[h]') +
+                array('2010-01-01T00', dtype='datetime64[h]').astype('int64')
+                ).astype('datetime64[s]')
+
+    def write(self, data):
+        ncfile = Dataset(self.filename, 'w', format='NETCDF4')
+        ncfile.createDimension('time', None)
+        write_time(ncfile, data['time'])
+        write_variables(ncfile, data, exclude=['time'])
+        ncfile.close()
+
+    def append(self, data):
+        ncfile = Dataset(self.filename, 'a')
+        try:
+            return append_variables(ncfile, data, 'time')
+        finally:
+            ncfile.close()
+
+    def read(self, name):
+        ncfile = Dataset(self.filename, 'r')
+        ncvar = ncfile.variables[name]
+        ncvar.set_auto_maskandscale(False)
+        values = ncvar[:]
+        ncfile.close()
+        return values
+
+    def test_append_fractional_to_integral_float_column(self):
+        '''
+        a float column that is integer valued when written keeps its
+        fractional values on append
+        '''
+        self.write({'time': self.hours(0, 2),
+                    'precip': array([0., 1.]),
+                    'dewpoint': array([-999., -999.])})
+        self.assertEqual(self.append({'time': self.hours(2, 2),
+                                      'precip': array([0.4, 2.7]),
+                                      'dewpoint': array([1.5, -999.])}), 2)
+        testing.assert_allclose(self.read('precip'), [0., 1., 0.4, 2.7],
+                                rtol=1e-6)
+        testing.assert_allclose(self.read('dewpoint'),
+                                [-999., -999., 1.5, -999.], rtol=1e-6)
+
+    def test_append_fractional_to_integer_column(self):
+        '''
+        fractional values cannot be appended to an integer variable
+        '''
+        self.write({'time': self.hours(0, 2), 'DD': array([10, 20])})
+        with self.assertRaises(ValueError):
+            self.append({'time': self.hours(2, 2), 'DD': array([0.4, 2.7])})
+        # nothing is appended
+        self.assertEqual(len(self.read('time')), 2)
+        # integer valued floats can still be appended
+        self.assertEqual(self.append({'time': self.hours(2, 1),
+                                      'DD': array([30.])}), 1)
+        testing.assert_array_equal(self.read('DD'), [10, 20, 30])
+
+    def test_chunksize_of_short_first_write(self):
+        '''
+        the chunk size along the unlimited time dimension does not depend
+        on the length of the first write
+        '''
+        self.write({'time': self.hours(0, 1), 'DD': array([10]),
+                    'name': array(['x'])})
+        self.append({'time': self.hours(1, 2), 'DD': array([20, 30]),
+                     'name': array(['x', 'x'])})
+        ncfile = Dataset(self.filename, 'r')
+        for name in ['time', 'DD', 'name']:
+            self.assertEqual(ncfile.variables[name].chunking(),
+                             [TIME_CHUNKSIZE])
+        ncfile.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,7 +6,14 @@ Description:    Shared functionality:
                     * progressbar(it, prefix="", size=60)
                     * is_number(s)
                     * wind_components(wind_speed, wind_direction)
+                    * ismember_indices(a, b, missing=-1)
                     * ismember(a, b)
+                    * ismember2(a, b)
+                    * datetime_axis(yyyymmdd, hh)
+                    * haversine(lon1, lat1, lon2, lat2)
+                    * haversine_array(lon1, lat1, lon2, lat2)
+                    * ReprojectCoords(coords, src_srs, tgt_srs)
+                    * reproject_coords(x, y, src_epsg=4326, tgt_epsg=28992)
 Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
 Created:
 Last Modified:
@@ -21,7 +28,6 @@ from numpy import cos as npcos
 from numpy import radians as npradians
 import csv
 from math import radians, cos, sin, asin, sqrt
-from osgeo import osr
 
 # define global LOG variables
 DEFAULT_LOG_LEVEL = 'debug'
@@ -88,32 +94,89 @@ def wind_components(wind_speed, wind_direction):
     V = wind_speed * npcos(npradians(wind_direction)) * -1
     return U, V
 
+def ismember_indices(a, b, missing=-1):
+    '''
+    align the items of a with b using sorting instead of hashing:
+        indices: for every item of a the index of its first occurrence in b,
+                 missing if it does not occur in b
+        found: boolean mask, True where the item of a occurs in b
+    a and b can be any sortable numpy arrays (numbers, strings, datetime64
+    with any time unit), so b[indices[found]] == a[found]
+    complexity O((n + m) log m) time and O(n + m) memory for len(a) = n and
+    len(b) = m, without any per element Python operations
+    '''
+    from numpy import argsort as npargsort
+    from numpy import asarray as npasarray
+    from numpy import promote_types as nppromote_types
+    from numpy import searchsorted as npsearchsorted
+    from numpy import where as npwhere
+    from numpy import zeros as npzeros
+    a = npasarray(a)
+    b = npasarray(b)
+    if a.dtype != b.dtype and a.size and b.size:
+        # e.g. datetime64 arrays in different units
+        common = nppromote_types(a.dtype, b.dtype)
+        a, b = a.astype(common), b.astype(common)
+    if b.size == 0:
+        return (npzeros(a.shape, dtype='int64') + missing,
+                npzeros(a.shape, dtype=bool))
+    # stable sort: equal items keep their order, so the left insertion
+    # point is the first occurrence in b
+    order = npargsort(b, kind='mergesort')
+    sorted_b = b[order]
+    position = npsearchsorted(sorted_b, a, side='left')
+    position[position == len(b)] = len(b) - 1
+    found = sorted_b[position] == a
+    indices = npwhere(found, order[position], missing).astype('int64')
+    return indices, found
+
 def ismember(a, b):
     '''
-    return items in a that are also in b
+    return for every item in a the index of its first occurrence in b,
+    None for items that are not in b
+    (use ismember_indices for index arrays)
     '''
-    bind = {}
-    for i, elt in enumerate(b):
-        if elt not in bind:
-            bind[elt] = i
-    # None can be replaced by any other "not in b" value
-    #return [bind.get(itm, None) for itm in a]
-    return [bind.get(itm, None) for itm in a]
+    indices, found = ismember_indices(a, b)
+    return [idx if ok else None for idx, ok in
+            zip(indices.tolist(), found.tolist())]
 
 def ismember2(a, b):
-    from numpy import sort
-    ind_dict = dict((k,i) for i,k in enumerate(b))
-    #Now, build your sets as before:
-    inter = set(ind_dict).intersection(a)
-    #Now, to get a list of indices:
-    indices = sort([ ind_dict[x] for x in inter ])
-    return indices
-    
-
-def write_csvfile(csvfile, data_out):
+    '''
+    return the sorted indices of the items in b that are also in a,
+    for repeated items in b only the last occurrence is returned
+    '''
+    from numpy import asarray as npasarray
+    from numpy import nonzero as npnonzero
+    from numpy import sort as npsort
+    from numpy import unique as npunique
+    b = npasarray(b)
+    members = npnonzero(ismember_indices(b, a)[1])[0][::-1]
+    # first occurrence in the reversed members is the last in b
+    first = npunique(b[members], return_index=True)[1]
+    return npsort(members[first])
+
+def datetime_axis(yyyymmdd, hh):
+    '''
+    build a datetime64 axis from integer YYYYMMDD and HH (0-24) columns,
+    HH=24 is HH=0 on the next day
+    '''
+    from numpy import asarray as npasarray
+    yyyymmdd = npasarray(yyyymmdd, dtype='int64')
+    years = (yyyymmdd // 10000 - 1970).astype('datetime64[Y]')
+    months = (years.astype('datetime64[M]') +
+              (yyyymmdd // 100 % 100 - 1).astype('timedelta64[M]'))
+    days = (months.astype('datetime64[D]') +
+            (yyyymmdd % 100 - 1).astype('timedelta64[D]'))
+    return days.astype('datetime64[s]') + (
+        npasarray(hh, dtype='int64') * 3600).astype('timedelta64[s]')
+
+
+def write_csvfile(csvfile, data_out, header=None):
     # TODO: check if csv file exists already
     with open(csvfile, 'w') as fp:
         a = csv.writer(fp, delimiter=',')
+        if header is not None:
+            a.writerow(header)
         a.writerows(data_out)
 
 def haversine(lon1, lat1, lon2, lat2):
@@ -131,6 +194,25 @@ def haversine(lon1, lat1, lon2, lat2):
     km = 6367 * c
     return km
 
+def haversine_array(lon1, lat1, lon2, lat2):
+    """
+    Calculate the great circle distance in km between arrays of points
+    on the earth (specified in decimal degrees), the input arrays are
+    broadcast against each other
+    """
+    from numpy import arcsin as nparcsin
+    from numpy import minimum as npminimum
+    from numpy import sqrt as npsqrt
+    # convert decimal degrees to radians
+    lon1, lat1, lon2, lat2 = [npradians(x) for x in [lon1, lat1, lon2, lat2]]
+    # haversine formula
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = npsin(dlat/2)**2 + npcos(lat1) * npcos(lat2) * npsin(dlon/2)**2
+    c = 2 * nparcsin(npsqrt(npminimum(a, 1)))
+    km = 6367 * c
+    return km
+
 def ReprojectCoords(coords,src_srs,tgt_srs):
     ''' Reproject a list of x,y coordinates.
 
@@ -149,10 +231,55 @@ def ReprojectCoords(coords,src_srs,tgt_srs):
             src_srs=osr.SpatialReference()
             src_srs.ImportFromEPSG(4326)  # lat/lon srs
     '''
+    from osgeo import osr
     transform = osr.CoordinateTransformation( src_srs, tgt_srs)
     x,y,z = transform.TransformPoint(coords[0],coords[1])
     return x, y
 
+# coordinate transformations: (src_epsg, tgt_epsg) -> transformation
+TRANSFORMATIONS = {}
+
+def get_transformation(src_epsg, tgt_epsg):
+    '''
+    return the (cached) osr.CoordinateTransformation between two EPSG codes,
+    coordinates are in x,y (lon,lat) order
+    '''
+    key = (int(src_epsg), int(tgt_epsg))
+    if key not in TRANSFORMATIONS:
+        from osgeo import osr
+        srs = []
+        for epsg in key:
+            spatial_reference = osr.SpatialReference()
+            spatial_reference.ImportFromEPSG(epsg)
+            if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+                # GDAL >= 3 uses lat,lon order for EPSG:4326 by default
+                spatial_reference.SetAxisMappingStrategy(
+                    osr.OAMS_TRADITIONAL_GIS_ORDER)
+            srs.append(spatial_reference)
+        TRANSFORMATIONS[key] = osr.CoordinateTransformation(srs[0], srs[1])
+    return TRANSFORMATIONS[key]
+
+def reproject_coords(x, y, src_epsg=4326, tgt_epsg=28992):
+    '''
+    Reproject arrays of x,y coordinates in a single call.
+
+        x, y:       arrays (or scalars) of coordinates in src_epsg
+        src_epsg:   EPSG code of the input coordinates (default lat/lon)
+        tgt_epsg:   EPSG code of the output coordinates (default Amersfoort)
+        return:     numpy arrays x, y in tgt_epsg with the shape of the input
+    '''
+    from numpy import array
+    from numpy import asarray
+    from numpy import broadcast_arrays
+    x, y = broadcast_arrays(asarray(x, dtype='float64'),
+                            asarray(y, dtype='float64'))
+    if x.size == 0:
+        return x.copy(), y.copy()
+    transform = get_transformation(src_epsg, tgt_epsg)
+    points = array(transform.TransformPoints(
+        list(zip(x.ravel().tolist(), y.ravel().tolist()))))
+    return points[:, 0].reshape(x.shape), points[:, 1].reshape(x.shape)
+
 def merge_two_dicts(x, y):
     '''
     Given two dicts, merge them into a new dict as a shallow copy.
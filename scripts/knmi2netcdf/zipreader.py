@@ -0,0 +1,67 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Streaming reader for members of zip archives:
+                    * iter_lines(fileobj, buffer_size=BUFFER_SIZE)
+                    * read_members(archive, readers)
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:        -
+Last Modified:  -
+License:        Apache 2.0
+Notes:          Members are decompressed while they are parsed, the
+                decompressed content is never held in memory as a whole.
+'''
+
+import fnmatch
+import zipfile
+
+# size of the blocks read from a zip member
+BUFFER_SIZE = 1024 * 1024
+
+
+def iter_lines(fileobj, buffer_size=BUFFER_SIZE):
+    '''
+    yield the lines of fileobj (including the line ending), the file is
+    read in blocks of buffer_size bytes
+    '''
+    remainder = ''
+    while True:
+        block = fileobj.read(buffer_size)
+        if not block:
+            break
+        lines = (remainder + block).split('\n')
+        # the last line is incomplete until the next block is read
+        remainder = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if remainder:
+        yield remainder
+
+
+def read_members(archive, readers):
+    '''
+    open archive (file name or file object) once and parse members with
+    readers, a list of (pattern, reader) tuples:
+        pattern: fnmatch pattern of the member name
+        reader: function reader(member, info) that parses the opened member
+                (a file object), info is its zipfile.ZipInfo
+    returns a list with the result of every reader for the first member
+    that matches its pattern, None if no member matches
+    '''
+    zipf = zipfile.ZipFile(archive)
+    try:
+        names = zipf.namelist()
+        results = []
+        for pattern, reader in readers:
+            matches = fnmatch.filter(names, pattern)
+            if not matches:
+                results.append(None)
+                continue
+            member = zipf.open(matches[0])
+            try:
+                results.append(reader(member, zipf.getinfo(matches[0])))
+            finally:
+                member.close()
+        return results
+    finally:
+        zipf.close()